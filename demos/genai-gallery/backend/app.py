@@ -56,13 +56,19 @@ sagemaker_endpoint_stack.add_dependency(codebuild_status_checker_stack)
 # Create the Lambda Functions stack
 lambda_functions_stack = ImageProcessingLambdaStack(app, "ImageProcessingLambdaStack",
                                               roop_endpoint_name=sagemaker_endpoint_stack.roop_endpoint_name,
-                                              gfpgan_endpoint_name=sagemaker_endpoint_stack.gfpgan_endpoint_name)
+                                              gfpgan_endpoint_name=sagemaker_endpoint_stack.gfpgan_endpoint_name,
+                                              roop_success_topic=sagemaker_endpoint_stack.roop_success_topic,
+                                              roop_error_topic=sagemaker_endpoint_stack.roop_error_topic,
+                                              gfpgan_error_topic=sagemaker_endpoint_stack.gfpgan_error_topic)
 
 # Add dependency to ensure Lambda Functions are created after the SageMaker Endpoints
 lambda_functions_stack.add_dependency(sagemaker_endpoint_stack)
 
 # Create the API Gateway stack
-api_gateway_stack = ApiGatewayStack(app, "ApiGatewayStack")
+api_gateway_stack = ApiGatewayStack(app, "ApiGatewayStack",
+                                    job_table=lambda_functions_stack.job_table,
+                                    result_distribution=lambda_functions_stack.result_distribution,
+                                    cdn_public_key=lambda_functions_stack.cdn_public_key)
 
 # Add dependency to ensure API Gateway is created after the Lambda Functions
 api_gateway_stack.add_dependency(lambda_functions_stack)
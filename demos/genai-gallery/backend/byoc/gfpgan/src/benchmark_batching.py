@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Throughput and tail latency of the GPU serving mode for different MAX_BATCH_SIZE values.
+# It runs the real ModelServer / ModelClient / DynamicBatcher path over a unix socket with a
+# stub model on CPU, so it needs neither a GPU nor the GFPGAN weights:
+#
+#   python benchmark_batching.py --clients 4 --requests 400 --batch-sizes 1 2 4 8
+#
+# In production the callers are the MODEL_SERVER_WORKERS sync gunicorn workers, one call in flight
+# each, i.e. 4 on an ml.g4dn.xlarge; more clients than workers overstate what batching gains.
+#
+# The stub forward pass costs a fixed overhead per call (kernel launch, host/device sync)
+# plus a float32 matmul over every face in the batch, which is what batching amortises.
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from batcher import DynamicBatcher
+from model_server import ModelClient, ModelServer
+
+
+class StubRestorer:
+    def __init__(self, overhead_ms, features=1024):
+        self.overhead = overhead_ms / 1000
+        rng = np.random.default_rng(0)
+        self.weights = rng.standard_normal((features, features), dtype=np.float32)
+
+    def forward(self, faces):
+        time.sleep(self.overhead)
+        return np.tanh(faces @ self.weights)
+
+    def restore(self, face):
+        return self.forward(face[np.newaxis])[0]
+
+    def restore_batch(self, batch):
+        return list(self.forward(np.stack([face for face, in batch])))
+
+
+def run(batch_size, args):
+    address = os.path.join(tempfile.mkdtemp(), 'model_server.sock')
+    model = StubRestorer(args.overhead_ms)
+    server = ModelServer(model, address, queue_depth=args.clients,
+                         batcher=DynamicBatcher(model, batch_size, args.window_ms))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    client = ModelClient(address)
+    while not client.is_ready():
+        time.sleep(0.01)
+
+    face = np.random.default_rng(1).standard_normal(1024, dtype=np.float32)
+    latencies = []
+    lock = threading.Lock()
+    per_client = args.requests // args.clients
+
+    def worker():
+        for _ in range(per_client):
+            start = time.perf_counter()
+            client.restore(face)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+    print(f"batch={batch_size:<3} throughput={len(latencies) / elapsed:8.1f} req/s "
+          f"p50={statistics.median(latencies) * 1000:7.1f} ms p99={p99 * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='model server throughput and p99 per batch size')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent callers (gunicorn workers, MODEL_SERVER_WORKERS)')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--window-ms', type=float, default=10)
+    parser.add_argument('--overhead-ms', type=float, default=20, help='fixed cost of one stub forward pass')
+    args = parser.parse_args()
+
+    for batch_size in args.batch_sizes:
+        run(batch_size, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    # Registers AVIF with Pillow versions that do not support it natively (before 11.2)
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+s3_client = boto3.client('s3')
+
+# Scratch files are only used by the subprocess fallback; keep them on tmpfs when there is one
+SCRATCH_ROOT = os.environ.get('SCRATCH_ROOT', '/dev/shm' if os.path.isdir('/dev/shm') else None)
+MAX_TRANSFER_WORKERS = int(os.environ.get('MAX_TRANSFER_WORKERS', 8))
+
+# Images passed between pipeline stages use the 'output_format' of the request (see encode_image)
+CONTENT_TYPES = {'.png': 'image/png', '.webp': 'image/webp', '.avif': 'image/avif', '.npy': 'application/x-npy'}
+
+# Request bodies that carry the input image itself instead of an S3 reference (see read_request)
+INLINE_IMAGE_TYPES = ('image/png', 'image/jpeg')
+
+# Downsized renditions written next to each final result as {uuid}.{variant}.{format}: name -> longest edge
+RESULT_VARIANTS = {'thumb': int(os.environ.get('THUMB_EDGE', 320)), 'screen': int(os.environ.get('SCREEN_EDGE', 1280))}
+# AVIF at speed 8 encodes about 3x faster than the default 6 and is still smaller than the WebP
+RESULT_VARIANT_OPTIONS = {'webp': {'quality': 80}, 'avif': {'quality': 60, 'speed': 8}}
+# Low-resolution preview of the swap that clients show while GFPGAN restores the final image
+PREVIEW_EDGE = int(os.environ.get('PREVIEW_EDGE', 480))
+Image.init()
+AVIF_SUPPORTED = 'AVIF' in Image.SAVE
+
+# boto3 clients are thread safe, so every transfer thread shares s3_client
+transfer_pool = ThreadPoolExecutor(max_workers=MAX_TRANSFER_WORKERS)
+
+
+def get_s3_image(s3_bucket, object_key):
+    # Retrieve the image from S3 into memory
+    print(f"get_s3_image: {s3_bucket}/{object_key}")
+    response = s3_client.get_object(Bucket=s3_bucket, Key=object_key)
+    return response['Body'].read()
+
+
+def get_s3_image_and_metadata(s3_bucket, object_key):
+    # The user metadata of the object (x-amz-meta-*) comes with the same GET
+    print(f"get_s3_image: {s3_bucket}/{object_key}")
+    response = s3_client.get_object(Bucket=s3_bucket, Key=object_key)
+    return response['Body'].read(), response.get('Metadata', {})
+
+
+def fetch_images(bucket, object_keys):
+    # Download every object at the same time, results keep the order of object_keys
+    futures = [transfer_pool.submit(get_s3_image, bucket, object_key) for object_key in object_keys]
+    return [future.result() for future in futures]
+
+
+def upload_image(bucket, object_key, image_bytes, content_type=None):
+    content_type = content_type or CONTENT_TYPES.get(os.path.splitext(object_key)[1], 'application/octet-stream')
+    print(f"upload_image: {bucket}/{object_key} ({len(image_bytes)} bytes)")
+    response = s3_client.put_object(Bucket=bucket, Key=object_key, Body=image_bytes, ContentType=content_type)
+    return response['ETag']
+
+
+def upload_images(bucket, images, last=()):
+    # Upload every (object_key, image_bytes) at the same time, returns {object_key: etag}. The keys in last follow
+    # once the others are in place: a final result after its renditions, so that its S3 event finds them.
+    etags = upload_concurrently(bucket, {key: image for key, image in images.items() if key not in last})
+    etags.update(upload_concurrently(bucket, {key: image for key, image in images.items() if key in last}))
+    return etags
+
+
+def upload_concurrently(bucket, images):
+    futures = {object_key: transfer_pool.submit(upload_image, bucket, object_key, image_bytes) for object_key, image_bytes in images.items()}
+    return {object_key: future.result() for object_key, future in futures.items()}
+
+
+def read_request(request):
+    """Returns (input_data, {name: image bytes}) of a JSON, image/png, image/jpeg or multipart/form-data request.
+
+    A JSON body references its images in S3 and has no inline images. An image body is the 'source'
+    image, and a multipart body has one file part per image. The other fields of an image body come from
+    the SageMaker custom attributes or the query string (key=value&...), those of a multipart body also
+    from its form fields.
+    """
+    if request.mimetype in INLINE_IMAGE_TYPES:
+        return request_parameters(request), {'source': request.get_data()}
+    if request.mimetype == 'multipart/form-data':
+        return {**request_parameters(request), **request.form.to_dict()}, {name: file.read() for name, file in request.files.items()}
+    return request.get_json(force=True), {}
+
+
+def request_parameters(request):
+    # invoke_endpoint passes CustomAttributes as the X-Amzn-SageMaker-Custom-Attributes header
+    attributes = urllib.parse.parse_qsl(request.headers.get('X-Amzn-SageMaker-Custom-Attributes', ''))
+    return {**request.args.to_dict(), **dict(attributes)}
+
+
+def content_type(image_format):
+    # Content type of the bytes encode_image returns for image_format
+    return CONTENT_TYPES.get(f".{image_format.split('-')[0]}", 'application/octet-stream')
+
+
+def decode_image(image_bytes, object_key=''):
+    # cv2 recognises PNG, JPEG and WebP from their content; raw arrays are told apart by the key
+    if object_key.endswith('.npy'):
+        return np.load(io.BytesIO(image_bytes), allow_pickle=False)
+
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Unable to decode image")
+    return image
+
+
+def encode_image(image, image_format='png'):
+    if image_format == 'npy':
+        # The raw BGR array, nothing to encode or decode
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(image), allow_pickle=False)
+        return buffer.getvalue()
+
+    if image_format == 'webp':
+        # Lossless WebP through OpenCV has no speed setting and takes seconds per megapixel
+        buffer = io.BytesIO()
+        Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(buffer, format='webp', lossless=True, method=0, quality=0)
+        return buffer.getvalue()
+
+    if image_format not in ('png', 'png-fast'):
+        raise ValueError(f"Unknown image format {image_format}")
+    # OpenCV's default PNG settings are already its fastest, so png and png-fast are the same here
+    success, encoded = cv2.imencode('.png', image)
+    if not success:
+        raise ValueError(f"Unable to encode image as {image_format}")
+    return encoded.tobytes()
+
+
+def result_variants(image, output_key):
+    """Encodes the thumbnail and screen-size WebP/AVIF renditions of a final result, {object_key: bytes}."""
+    root = os.path.splitext(output_key)[0]
+    original = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    formats = ['webp', 'avif'] if AVIF_SUPPORTED else ['webp']
+
+    variants = {}
+    for name, edge in RESULT_VARIANTS.items():
+        resized = original.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS, reducing_gap=2.0)
+        for image_format in formats:
+            buffer = io.BytesIO()
+            resized.save(buffer, format=image_format, **RESULT_VARIANT_OPTIONS[image_format])
+            variants[f"{root}.{name}.{image_format}"] = buffer.getvalue()
+    return variants
+
+
+def preview_image(image):
+    """Encodes a small, lossy WebP of an intermediate result for clients to show until the final one exists."""
+    preview = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    preview.thumbnail((PREVIEW_EDGE, PREVIEW_EDGE), Image.BILINEAR, reducing_gap=2.0)
+    buffer = io.BytesIO()
+    preview.save(buffer, format='webp', quality=60, method=0)
+    return buffer.getvalue()
+
+
+def as_image_file(image_bytes, object_key):
+    # The run.py / inference_gfpgan.py subprocesses read their input with cv2.imread, which has no raw array support
+    if object_key.endswith('.npy'):
+        return encode_image(decode_image(image_bytes, object_key), 'png-fast')
+    return image_bytes
+
+
+@contextlib.contextmanager
+def scratch_dir():
+    # Removed on exit even when inference raises
+    path = tempfile.mkdtemp(prefix='predictor-', dir=SCRATCH_ROOT)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def read_file(path):
+    with open(path, "rb") as file:
+        return file.read()
@@ -1,81 +1,93 @@
-from flask import Flask, request, jsonify
-import boto3
-import subprocess
+from flask import Flask, Response, request, jsonify
 import os
 
+from image_io import read_request, content_type, fetch_images, upload_images, decode_image, encode_image, as_image_file, result_variants, scratch_dir, write_file, read_file
+from model_server import ModelClient, ModelServerBusy
+from restorer import create_model, run_gfpgan_subprocess
+
 app = Flask(__name__)
-s3_client = boto3.client('s3')
+
+# 'resident' keeps GFPGAN loaded in each worker, 'subprocess' starts inference_gfpgan.py per request
+GFPGAN_ENGINE = os.environ.get('GFPGAN_ENGINE', 'resident')
+# 'worker' loads the model in every gunicorn worker, 'gpu' sends the restores to the single model server
+SERVING_MODE = os.environ.get('SERVING_MODE', 'worker')
+
+
+if GFPGAN_ENGINE != 'resident':
+    gfpgan_restorer = None
+elif SERVING_MODE == 'gpu':
+    gfpgan_restorer = ModelClient()
+else:
+    gfpgan_restorer = create_model()
 
 
 @app.route('/ping', methods=['GET'])
 def ping():
-    health = True  # You can implement health check logic here
+    health = not isinstance(gfpgan_restorer, ModelClient) or gfpgan_restorer.is_ready()
     status = 200 if health else 404
     return '', status
 
 
+@app.errorhandler(ModelServerBusy)
+def model_server_busy(error):
+    return jsonify({'error': str(error)}), 503
+
+
 @app.route('/invocations', methods=['POST'])
 def invocations():
-    input_data = request.get_json(force=True)
+    input_data, inline_images = read_request(request)
+    if inline_images:
+        # The image comes in the request and the restored PNG goes back in the response, without S3
+        if 'source' not in inline_images:
+            return jsonify({'error': "Missing the source image"}), 400
+        _, output_image = restore_image(inline_images['source'], '')
+        return Response(output_image, mimetype=content_type('png'))
 
-    uuid = input_data['uuid']
     bucket = input_data['bucket']
     source_object_key = input_data['source']
     output_object_key = input_data['output']
-    source_path = f"/opt/workspace/source/{uuid}.png"
-    output_path = f"/opt/workspace/output"
-    output_file_path = f"/opt/workspace/output/restored_imgs/{uuid}.png"
-
-    fetch_images(bucket, source_object_key, source_path)
 
-    process_images(source_path, output_path)
+    source_image, = fetch_images(bucket, [source_object_key])
 
-    s3_client.upload_file(output_file_path, bucket, output_object_key)
+    output_images = process_images(source_image, source_object_key, output_object_key)
 
-    remove_all_files(source_path, output_file_path)
+    # The restored result after its renditions, so that its S3 event finds them
+    etags = upload_images(bucket, output_images, last=[output_object_key])
 
-    return jsonify(input_data)
+    return completion_response(input_data, etags)
 
 
-def fetch_images(bucket, source_object_key, source_path):
-    print(f"fetch_images called")
+def completion_response(input_data, etags):
+    # The outputs are in S3 by the time the caller gets this, so it does not need to poll for them
+    return jsonify({**input_data, 'status': 'completed', 'outputs': etags})
 
-    source_image = get_s3_image(bucket, source_object_key)
 
-    os.makedirs(os.path.dirname(source_path), exist_ok=True)
-    with open(source_path, "wb") as file:
-        file.write(source_image)
+def process_images(source_image, source_object_key, output_object_key):
+    print(f"process_images called")
 
-    # if file is exists in source_path, then print file size
-    if os.path.exists(source_path):
-        print(f"source_path size: {os.path.getsize(source_path)}")
+    result, output_image = restore_image(source_image, source_object_key)
 
+    return {output_object_key: output_image, **result_variants(result, output_object_key)}
 
-def process_images(source_path, output_path):
-    print(f"process_images called")
 
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+def restore_image(source_image, source_object_key):
+    # The source is the intermediate image of the swap stage; the restored result is always PNG
+    if gfpgan_restorer is None:
+        output_image = process_images_subprocess(as_image_file(source_image, source_object_key))
+        return decode_image(output_image), output_image
 
-    command = [
-        "python", "/opt/program/GFPGAN/inference_gfpgan.py",
-        "-i", source_path,
-        "-o", output_path
-    ]
+    result = gfpgan_restorer.restore(decode_image(source_image, source_object_key))
+    return result, encode_image(result, 'png')
 
-    print(f"command: {command}")
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-    while p.poll() == None:
-        out = p.stdout.readline()
-        print(out, end='')
 
+def process_images_subprocess(source_image):
+    # inference_gfpgan.py only reads and writes files, so give it a scratch directory
+    with scratch_dir() as workdir:
+        source_path = os.path.join(workdir, "input", "source.png")
+        output_path = os.path.join(workdir, "output")
 
-def remove_all_files(source_path, output_path):
-    os.remove(source_path)
-    os.remove(output_path)
+        write_file(source_path, source_image)
 
+        run_gfpgan_subprocess(source_path, output_path)
 
-def get_s3_image(s3_bucket, object_key):
-    # Retrieve the image from S3 into memory
-    print(f"get_s3_image: {s3_bucket}/{object_key}")
-    response = s3_client.get_object(Bucket=s3_bucket, Key=object_key)
-    return response['Body'].read()
+        return read_file(os.path.join(output_path, "restored_imgs", "source.png"))
@@ -0,0 +1,129 @@
+import copy
+import fcntl
+import os
+import subprocess
+
+import torch
+from basicsr.utils import img2tensor, tensor2img
+from gfpgan import GFPGANer
+from torchvision.transforms.functional import normalize
+
+GFPGAN_PATH = os.environ.get('GFPGAN_PATH', '/opt/program/GFPGAN')
+MODEL_LOCK_PATH = '/tmp/gfpgan-model.lock'
+
+# Same defaults as GFPGAN/inference_gfpgan.py, which the subprocess path runs with no options
+MODEL_NAME = 'GFPGANv1.3'
+MODEL_URL = 'https://github.com/TencentARC/GFPGAN/releases/download/v1.0.0/GFPGANv1.3.pth'
+BG_UPSAMPLER_URL = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth'
+UPSCALE = 2
+BG_TILE = 400
+WEIGHT = 0.5
+
+
+class GfpganRestorer:
+    """Keeps a GFPGANer (with its RetinaFace helper and RealESRGAN background
+    upsampler) resident in the process.
+
+    ``restore`` returns the same image that ``inference_gfpgan.py`` writes to
+    ``restored_imgs/`` for the given input.
+    """
+
+    def __init__(self):
+        # gunicorn boots every worker at the same time; load one at a time so that
+        # only the first worker downloads the GFPGAN, RetinaFace and RealESRGAN weights.
+        with open(MODEL_LOCK_PATH, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.restorer = GFPGANer(
+                model_path=resolve_model_path(),
+                upscale=UPSCALE,
+                arch='clean',
+                channel_multiplier=2,
+                bg_upsampler=create_bg_upsampler())
+
+    def restore(self, image):
+        _, _, restored_image = self.restorer.enhance(
+            image, has_aligned=False, only_center_face=False, paste_back=True, weight=WEIGHT)
+        return restored_image
+
+    @torch.no_grad()
+    def restore_batch(self, batch):
+        # GFPGANer.enhance split in three so that the faces of every image share one forward pass.
+        # Each image gets a shallow copy of the face helper: the detection and parsing models are
+        # shared, while clean_all() gives the copy its own landmark, crop and affine state.
+        helpers = []
+        for image, in batch:
+            helper = copy.copy(self.restorer.face_helper)
+            helper.clean_all()
+            helper.read_image(image)
+            helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+            helper.align_warp_face()
+            helpers.append(helper)
+
+        cropped_faces = [face for helper in helpers for face in helper.cropped_faces]
+        if cropped_faces:
+            faces = []
+            for cropped_face in cropped_faces:
+                face = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+                normalize(face, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+                faces.append(face)
+            output = self.restorer.gfpgan(torch.stack(faces).to(self.restorer.device), return_rgb=False, weight=WEIGHT)[0]
+            restored_faces = iter([tensor2img(face, rgb2bgr=True, min_max=(-1, 1)).astype('uint8') for face in output])
+
+        restored_images = []
+        for (image,), helper in zip(batch, helpers):
+            for _ in helper.cropped_faces:
+                helper.add_restored_face(next(restored_faces))
+
+            bg_upsampler = self.restorer.bg_upsampler
+            bg_image = bg_upsampler.enhance(image, outscale=UPSCALE)[0] if bg_upsampler is not None else None
+
+            helper.get_inverse_affine(None)
+            restored_images.append(helper.paste_faces_to_input_image(upsample_img=bg_image))
+        return restored_images
+
+
+def resolve_model_path():
+    for model_dir in ('experiments/pretrained_models', 'gfpgan/weights'):
+        model_path = os.path.join(GFPGAN_PATH, model_dir, f"{MODEL_NAME}.pth")
+        if os.path.isfile(model_path):
+            return model_path
+    return MODEL_URL
+
+
+def create_bg_upsampler():
+    # inference_gfpgan.py only upsamples the background on GPU
+    if not torch.cuda.is_available():
+        print("CUDA is not available, the background will not be upsampled")
+        return None
+
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    from realesrgan import RealESRGANer
+
+    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+    return RealESRGANer(
+        scale=2,
+        model_path=BG_UPSAMPLER_URL,
+        model=model,
+        tile=BG_TILE,
+        tile_pad=10,
+        pre_pad=0,
+        half=True)
+
+
+def create_model():
+    return GfpganRestorer()
+
+
+def run_gfpgan_subprocess(source_path, output_path):
+    # Legacy path: start inference_gfpgan.py for a single restore
+    command = [
+        "python", os.path.join(GFPGAN_PATH, "inference_gfpgan.py"),
+        "-i", source_path,
+        "-o", output_path
+    ]
+
+    print(f"command: {command}")
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    while p.poll() == None:
+        out = p.stdout.readline()
+        print(out, end='')
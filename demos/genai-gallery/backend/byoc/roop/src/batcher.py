@@ -0,0 +1,66 @@
+import os
+import queue
+import time
+
+# Opt-in: with the default batch size of 1 every request runs on its own as before
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1))
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 10))
+
+
+class DynamicBatcher:
+    """Groups model calls that arrive within a short window into one batched call.
+
+    A model opts in per method by defining ``<method>_batch``, which takes the list of
+    argument tuples and returns one result per tuple. Methods without a batch variant,
+    and batches whose batch call raises, run one call at a time so that every caller
+    still gets its own result or error.
+    """
+
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, window_ms=BATCH_WINDOW_MS):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = window_ms / 1000
+
+    def next_batch(self, jobs, idle_callers=None):
+        # idle_callers() is how many callers could still send a call. Each caller has at most one call
+        # in flight, so once none is left the batch cannot grow and waiting out the window only adds latency.
+        batch = [jobs.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(jobs.get_nowait())
+                continue
+            except queue.Empty:
+                if idle_callers is not None and idle_callers() <= 0:
+                    break
+            try:
+                batch.append(jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self, batch):
+        groups = {}
+        for job in batch:
+            groups.setdefault(job.method, []).append(job)
+
+        for method, group in groups.items():
+            batch_method = getattr(self.model, f"{method}_batch", None)
+            if batch_method is not None and len(group) > 1:
+                try:
+                    results = batch_method([job.args for job in group])
+                except Exception as e:
+                    print(f"Batched {method} of {len(group)} failed, running them one by one: {e}")
+                else:
+                    for job, result in zip(group, results):
+                        job.outcome = ('ok', result)
+                    continue
+
+            for job in group:
+                try:
+                    job.outcome = ('ok', getattr(self.model, method)(*job.args))
+                except Exception as e:
+                    job.outcome = ('error', e)
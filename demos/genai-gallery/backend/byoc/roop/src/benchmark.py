@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Per-request latency of the roop swap, run.py subprocess vs. the resident FaceSwapper.
+# Run it inside the roop container (GPU instance) from /opt/program:
+#
+#   python benchmark.py --source face.png --target target.png --iterations 20
+#
+# The first resident call is reported separately because it includes the model load
+# that a gunicorn worker pays once at boot.
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import cv2
+
+from swapper import FaceSwapper, run_roop_subprocess
+
+
+def summarize(name, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))]
+    print(f"{name:<12} n={len(samples):<4} mean={statistics.mean(samples):8.3f}s "
+          f"p50={statistics.median(samples):8.3f}s p95={p95:8.3f}s max={samples[-1]:8.3f}s")
+
+
+def bench_subprocess(source_path, target_path, iterations):
+    samples = []
+    with tempfile.TemporaryDirectory() as workdir:
+        output_path = os.path.join(workdir, "output.png")
+        for _ in range(iterations):
+            start = time.perf_counter()
+            run_roop_subprocess(source_path, target_path, output_path)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_resident(source_path, target_path, iterations):
+    start = time.perf_counter()
+    face_swapper = FaceSwapper()
+    load_time = time.perf_counter() - start
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        # Same work as the predictor: decode both inputs, swap, encode the result
+        result = face_swapper.swap(cv2.imread(source_path), cv2.imread(target_path))
+        cv2.imencode('.png', result)
+        samples.append(time.perf_counter() - start)
+    return load_time, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='roop subprocess vs. resident swap latency')
+    parser.add_argument('--source', required=True, help='source (selfie) image path')
+    parser.add_argument('--target', required=True, help='target (base) image path')
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    subprocess_samples = bench_subprocess(args.source, args.target, args.iterations)
+    load_time, resident_samples = bench_resident(args.source, args.target, args.iterations)
+
+    print(f"resident model load (once per worker): {load_time:.3f}s")
+    summarize("subprocess", subprocess_samples)
+    summarize("resident", resident_samples)
+    print(f"speed-up (mean): {statistics.mean(subprocess_samples) / statistics.mean(resident_samples):.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# This file implements the GPU serving mode (SERVING_MODE=gpu). A single model server process owns
+# the model on the GPU, while the gunicorn workers only handle HTTP, S3 I/O and image decoding.
+# Workers send decoded arrays over a unix socket; the server puts each call on a bounded queue
+# that one model thread drains, so there is exactly one copy of the model in GPU memory.
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# model module             MODEL_MODULE                      set in the Dockerfile, provides create_model()
+# socket path              MODEL_SERVER_SOCKET               /tmp/model_server.sock
+# queue depth              MODEL_QUEUE_DEPTH                 16
+# queue wait timeout       MODEL_QUEUE_TIMEOUT               0 seconds (fail fast)
+# maximum batch size       MAX_BATCH_SIZE                    1 (no batching)
+# batching window          BATCH_WINDOW_MS                   10 milliseconds
+#
+# With MAX_BATCH_SIZE > 1 the model thread groups the calls that arrive within BATCH_WINDOW_MS
+# into one batched forward pass (see batcher.py) and sends each caller its own result. Every gunicorn
+# worker has at most one call in flight, so a batch never grows beyond MODEL_SERVER_WORKERS; the
+# model thread stops waiting as soon as every connected worker has its call in the batch.
+#
+# A call that finds the queue full fails at once with ModelServerBusy, which the predictor returns as
+# a 503. MODEL_QUEUE_TIMEOUT lets it wait for a free slot instead; keep it well below
+# MODEL_SERVER_TIMEOUT, since gunicorn kills a sync worker and SageMaker gives up on a real-time
+# invocation after 60 seconds, both before the 503 could be sent.
+
+import importlib
+import os
+import queue
+import threading
+from multiprocessing.connection import Client, Listener
+
+from batcher import DynamicBatcher
+
+MODEL_SERVER_SOCKET = os.environ.get('MODEL_SERVER_SOCKET', '/tmp/model_server.sock')
+MODEL_QUEUE_DEPTH = int(os.environ.get('MODEL_QUEUE_DEPTH', 16))
+MODEL_QUEUE_TIMEOUT = float(os.environ.get('MODEL_QUEUE_TIMEOUT', 0))
+
+
+class ModelServerBusy(RuntimeError):
+    pass
+
+
+class Job:
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.outcome = None
+        self.done = threading.Event()
+
+
+class ModelServer:
+    def __init__(self, model, address=MODEL_SERVER_SOCKET, queue_depth=MODEL_QUEUE_DEPTH, batcher=None):
+        self.batcher = batcher or DynamicBatcher(model)
+        self.address = address
+        self.jobs = queue.Queue(maxsize=queue_depth)
+        # Connected callers and the calls they have queued or in the running batch
+        self.callers = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        threading.Thread(target=self.run_model, daemon=True).start()
+
+        # The socket only appears once the model is loaded, workers use it as the readiness signal
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        with Listener(self.address, family='AF_UNIX') as listener:
+            print(f"Model server listening on {self.address} "
+                  f"(queue depth {self.jobs.maxsize}, max batch size {self.batcher.max_batch_size})")
+            while True:
+                connection = listener.accept()
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+    def handle_connection(self, connection):
+        self.count('callers', 1)
+        try:
+            with connection:
+                while True:
+                    try:
+                        method, args = connection.recv()
+                    except EOFError:
+                        return
+
+                    job = Job(method, args)
+                    try:
+                        self.jobs.put(job, block=MODEL_QUEUE_TIMEOUT > 0, timeout=MODEL_QUEUE_TIMEOUT or None)
+                    except queue.Full:
+                        job.outcome = ('error', ModelServerBusy(f"Model queue is full ({self.jobs.maxsize} requests)"))
+                    else:
+                        # Counted once queued and uncounted before the answer, so that the count never
+                        # exceeds the calls that are really waiting and a batch never stops too early
+                        self.count('calls', 1)
+                        job.done.wait()
+                    self.send(connection, job.outcome)
+        finally:
+            self.count('callers', -1)
+
+    def count(self, name, delta):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def idle_callers(self):
+        return self.callers - self.calls
+
+    def run_model(self):
+        while True:
+            batch = self.batcher.next_batch(self.jobs, self.idle_callers)
+            self.batcher.run(batch)
+            self.count('calls', -len(batch))
+            for job in batch:
+                job.done.set()
+
+    @staticmethod
+    def send(connection, outcome):
+        try:
+            connection.send(outcome)
+        except Exception as e:
+            # The result or the exception could not be pickled
+            connection.send(('error', RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+class ModelClient:
+    """Stands in for the model inside a gunicorn worker and forwards each method call to the model server."""
+
+    def __init__(self, address=MODEL_SERVER_SOCKET):
+        self.address = address
+        self.local = threading.local()
+
+    def is_ready(self):
+        return os.path.exists(self.address)
+
+    def call(self, method, *args):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = Client(self.address, family='AF_UNIX')
+
+        try:
+            connection.send((method, args))
+            status, value = connection.recv()
+        except (EOFError, OSError):
+            # The model server went away, reconnect on the next call
+            self.local.connection = None
+            raise
+
+        if status == 'error':
+            raise value
+        return value
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+
+if __name__ == '__main__':
+    # Run the server from the importable module rather than __main__, so that ModelServerBusy is
+    # pickled as model_server.ModelServerBusy, a name the gunicorn workers can unpickle
+    from model_server import ModelServer as ImportedModelServer
+    model_module = importlib.import_module(os.environ['MODEL_MODULE'])
+    ImportedModelServer(model_module.create_model()).serve_forever()
@@ -0,0 +1,38 @@
+import os
+
+from restorer import GfpganRestorer
+from swapper import FaceSwapper
+
+# 'swap' runs roop only; 'swap+restore' also runs the GFPGAN restore on the swapped image
+# so that one invocation produces the final result (fused pipeline mode)
+PIPELINE_MODE = os.environ.get('PIPELINE_MODE', 'swap')
+
+
+class SwapRestorePipeline(FaceSwapper):
+    """FaceSwapper that also keeps a GfpganRestorer resident and restores the swapped image in memory."""
+
+    def __init__(self):
+        super().__init__()
+        self.restorer = GfpganRestorer()
+
+    def restore(self, image):
+        return self.restorer.restore(image)
+
+    def restore_batch(self, batch):
+        return self.restorer.restore_batch(batch)
+
+    def swap_face_and_restore(self, source_frame, target_frame, target_face, source_hint=None):
+        swapped = self.swap_face(source_frame, target_frame, target_face, source_hint)
+        return swapped, self.restore(swapped)
+
+    def swap_faces_and_restore(self, source_frame, targets, source_hint=None):
+        # The faces of all swapped images share one GFPGAN forward pass
+        swapped = self.swap_faces(source_frame, targets, source_hint)
+        restored = self.restore_batch([(image,) for image in swapped]) if len(swapped) > 1 else [self.restore(image) for image in swapped]
+        return list(zip(swapped, restored))
+
+
+def create_model():
+    if PIPELINE_MODE == 'swap+restore':
+        return SwapRestorePipeline()
+    return FaceSwapper()
@@ -1,95 +1,200 @@
-from flask import Flask, request, jsonify
-import boto3
-import subprocess
+from flask import Flask, Response, request, jsonify
+import json
 import os
+import threading
+import time
 
-app = Flask(__name__)
-s3_client = boto3.client('s3')
-
-
-@app.route('/ping', methods=['GET'])
-def ping():
-    health = True  # You can implement health check logic here
-    status = 200 if health else 404
-    return '', status
-
-
-@app.route('/invocations', methods=['POST'])
-def invocations():
-    input_data = request.get_json(force=True)
-
-    uuid = input_data['uuid']
-    bucket = input_data['bucket']
-    source_object_key = input_data['source']
-    target_object_key = input_data['target']
-    output_object_key = input_data['output']
-    source_path = f"/opt/workspace/source/{uuid}.png"
-    target_path = f"/opt/workspace/target/{uuid}.png"
-    output_path = f"/opt/workspace/output/{uuid}.png"
+from image_io import read_request, content_type, fetch_images, get_s3_image_and_metadata, upload_images, decode_image, encode_image, as_image_file, result_variants, preview_image, scratch_dir, write_file, read_file
+from model_server import ModelClient, ModelServerBusy
+from pipeline import create_model, PIPELINE_MODE
+from swapper import run_roop_subprocess
+from target_cache import TargetFaceCache, TARGET_CACHE_BUCKET, TARGET_CACHE_PREFIX
 
-    fetch_images(bucket, source_object_key, source_path, target_object_key, target_path)
-
-    process_images(source_path, target_path, output_path)
-
-    s3_client.upload_file(output_path, bucket, output_object_key)
-
-    remove_all_files(source_path, target_path, output_path)
-
-    return jsonify(input_data)
+app = Flask(__name__)
 
+# 'resident' keeps roop loaded in each worker, 'subprocess' starts run.py per request
+ROOP_ENGINE = os.environ.get('ROOP_ENGINE', 'resident')
+# 'worker' loads the model in every gunicorn worker, 'gpu' sends the swaps to the single model server
+SERVING_MODE = os.environ.get('SERVING_MODE', 'worker')
+# Most targets one invocation swaps the source into; all of them have to finish within the invocation timeout
+MAX_TARGETS = int(os.environ.get('MAX_TARGETS', 8))
 
-def fetch_images(bucket, source_object_key, source_path, target_object_key, target_path):
-    print(f"fetch_images called")
 
-    source_image = get_s3_image(bucket, source_object_key)
-    target_image = get_s3_image(bucket, target_object_key)
+if ROOP_ENGINE != 'resident':
+    face_swapper = None
+elif SERVING_MODE == 'gpu':
+    face_swapper = ModelClient()
+else:
+    face_swapper = create_model()
 
-    os.makedirs(os.path.dirname(source_path), exist_ok=True)
-    with open(source_path, "wb") as file:
-        file.write(source_image)
+if PIPELINE_MODE == 'swap+restore' and face_swapper is None:
+    raise ValueError("PIPELINE_MODE=swap+restore needs ROOP_ENGINE=resident")
 
-    # if file is exists in source_path, then print file size
-    if os.path.exists(source_path):
-        print(f"source_path size: {os.path.getsize(source_path)}")
+target_cache = TargetFaceCache(face_swapper.analyse) if face_swapper is not None else None
 
-    os.makedirs(os.path.dirname(target_path), exist_ok=True)
-    with open(target_path, "wb") as file:
-        file.write(target_image)
 
-    # if file is exists in target_path, then print file size
-    if os.path.exists(target_path):
-        print(f"target_path size: {os.path.getsize(target_path)}")
+def preload_target_cache():
+    # In gpu mode the analysis runs on the model server, which may still be loading
+    while not getattr(face_swapper, 'is_ready', lambda: True)():
+        time.sleep(1)
+    try:
+        target_cache.preload(TARGET_CACHE_BUCKET, TARGET_CACHE_PREFIX)
+    except Exception as e:
+        print(f"Target face cache preload failed, targets will be analysed on first use: {e}")
 
 
-def process_images(source_path, target_path, output_path):
-    print(f"process_images called")
+if target_cache is not None and TARGET_CACHE_BUCKET:
+    threading.Thread(target=preload_target_cache, daemon=True).start()
 
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    command = [
-        "python", "/opt/program/roop/run.py",
-        "--execution-provider", "cuda",
-        "--source", source_path,
-        "--target", target_path,
-        "--output", output_path,
-        "--skip-audio"
-    ]
+@app.route('/ping', methods=['GET'])
+def ping():
+    health = not isinstance(face_swapper, ModelClient) or face_swapper.is_ready()
+    status = 200 if health else 404
+    return '', status
 
-    print(f"command: {command}")
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-    while p.poll() == None:
-        out = p.stdout.readline()
-        print(out, end='')
 
+@app.errorhandler(ModelServerBusy)
+def model_server_busy(error):
+    return jsonify({'error': str(error)}), 503
 
-def remove_all_files(source_path, target_path, output_path):
-    os.remove(source_path)
-    os.remove(target_path)
-    os.remove(output_path)
 
+@app.route('/invocations', methods=['POST'])
+def invocations():
+    input_data, inline_images = read_request(request)
+    if inline_images:
+        return inline_invocation(input_data, inline_images)
 
-def get_s3_image(s3_bucket, object_key):
-    # Retrieve the image from S3 into memory
-    print(f"get_s3_image: {s3_bucket}/{object_key}")
-    response = s3_client.get_object(Bucket=s3_bucket, Key=object_key)
-    return response['Body'].read()
+    bucket = input_data['bucket']
+    source_object_key = input_data['source']
+    # Codec of the output; intermediate images between stages may use a faster one than PNG
+    output_format = input_data.get('output_format', 'png')
+
+    # One source face into several targets: 'targets' is a list of {'target', 'output'}, each optionally
+    # with the 'intermediate' and 'preview' keys of a single swap
+    targets = input_data.get('targets') or [single_target(input_data)]
+    if len(targets) > MAX_TARGETS:
+        return jsonify({'error': f"At most {MAX_TARGETS} targets per invocation"}), 400
+
+    if face_swapper is None:
+        # run.py analyses the source again for every target
+        source_image, *target_images = fetch_images(bucket, [source_object_key] + [target['target'] for target in targets])
+        source_file = as_image_file(source_image, source_object_key)
+        output_images = {}
+        for target, target_image in zip(targets, target_images):
+            output_image = process_images_subprocess(source_file, target_image)
+            output_images.update(subprocess_outputs(output_image, target, output_format))
+        return completion_response(input_data, upload_images(bucket, output_images))
+
+    source_image, source_metadata = get_s3_image_and_metadata(bucket, source_object_key)
+    source_frame = decode_image(source_image, source_object_key)
+    source_hint = get_source_hint(input_data, source_metadata)
+    target_faces = [(cached.image, cached.face) for cached in (target_cache.get(bucket, target['target']) for target in targets)]
+
+    # The swaps run back to back on the resident model, with the source face analysed once
+    output_images = {}
+    if PIPELINE_MODE == 'swap+restore':
+        results = face_swapper.swap_faces_and_restore(source_frame, target_faces, source_hint)
+        for target, (swapped, restored) in zip(targets, results):
+            # Only the final image and its downsized variants are written, plus the swapped one when the caller asks for it
+            output_images[target['output']] = encode_image(restored, output_format)
+            output_images.update(result_variants(restored, target['output']))
+            if target.get('intermediate'):
+                output_images[target['intermediate']] = encode_image(swapped, input_data.get('intermediate_format', 'png'))
+    else:
+        results = face_swapper.swap_faces(source_frame, target_faces, source_hint)
+        for target, result in zip(targets, results):
+            output_images[target['output']] = encode_image(result, output_format)
+            if target.get('preview'):
+                output_images[target['preview']] = preview_image(result)
+
+    # All outputs of all targets are uploaded at the same time, final results after their renditions
+    final_keys = [target['output'] for target in targets] if PIPELINE_MODE == 'swap+restore' else []
+    etags = upload_images(bucket, output_images, last=final_keys)
+
+    return completion_response(input_data, etags)
+
+
+def inline_invocation(input_data, inline_images):
+    # The source face comes in the request and the result goes back in the response, without S3. The target is
+    # an inline image too or, as a base image of the target cache, an S3 key.
+    if 'source' not in inline_images:
+        return jsonify({'error': "Missing the source image"}), 400
+    if 'target' not in inline_images and not input_data.get('target'):
+        return jsonify({'error': "Missing the target image or key"}), 400
+
+    bucket = input_data.get('bucket', TARGET_CACHE_BUCKET)
+    output_format = input_data.get('output_format', 'png')
+    source_image = inline_images['source']
+
+    if face_swapper is None:
+        target_image = inline_images.get('target') or fetch_images(bucket, [input_data['target']])[0]
+        output_image = process_images_subprocess(source_image, target_image)
+        if output_format != 'png':
+            output_image = encode_image(decode_image(output_image), output_format)
+        return Response(output_image, mimetype=content_type(output_format))
+
+    source_frame = decode_image(source_image)
+    source_hint = get_source_hint(input_data, {})
+    if 'target' in inline_images:
+        target_frame = decode_image(inline_images['target'])
+        target_face = face_swapper.analyse(target_frame)
+    else:
+        target = target_cache.get(bucket, input_data['target'])
+        target_frame, target_face = target.image, target.face
+
+    if PIPELINE_MODE == 'swap+restore':
+        _, result = face_swapper.swap_face_and_restore(source_frame, target_frame, target_face, source_hint)
+    else:
+        result = face_swapper.swap_face(source_frame, target_frame, target_face, source_hint)
+    return Response(encode_image(result, output_format), mimetype=content_type(output_format))
+
+
+def single_target(input_data):
+    return {key: input_data[key] for key in ('target', 'output', 'intermediate', 'preview') if input_data.get(key)}
+
+
+def subprocess_outputs(output_image, target, output_format):
+    # run.py writes PNG, which is uploaded as is unless another codec or a preview is needed
+    if output_format == 'png' and not target.get('preview'):
+        return {target['output']: output_image}
+    result = decode_image(output_image)
+    outputs = {target['output']: output_image if output_format == 'png' else encode_image(result, output_format)}
+    if target.get('preview'):
+        outputs[target['preview']] = preview_image(result)
+    return outputs
+
+
+def get_source_hint(input_data, source_metadata):
+    # The face detection stage stores its detection of the source face as 'face-hint' metadata;
+    # a 'source_hint' in the request takes precedence. The swapper checks it before it skips its own detection.
+    # Metadata, and the fields of image and multipart requests, hold the hint as a JSON string.
+    hint = input_data.get('source_hint') or source_metadata.get('face-hint')
+    if not isinstance(hint, str):
+        return hint
+    try:
+        return json.loads(hint)
+    except ValueError:
+        return None
+
+
+def completion_response(input_data, etags):
+    # The outputs are in S3 by the time the caller gets this, so it does not need to poll for them
+    return jsonify({**input_data, 'status': 'completed', 'outputs': etags})
+
+
+def process_images_subprocess(source_image, target_image):
+    print(f"process_images_subprocess called")
+
+    # run.py only reads and writes files, so give it a scratch directory
+    with scratch_dir() as workdir:
+        source_path = os.path.join(workdir, "source.png")
+        target_path = os.path.join(workdir, "target.png")
+        output_path = os.path.join(workdir, "output.png")
+
+        write_file(source_path, source_image)
+        write_file(target_path, target_image)
+
+        run_roop_subprocess(source_path, target_path, output_path)
+
+        return read_file(output_path)
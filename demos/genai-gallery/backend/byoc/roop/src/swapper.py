@@ -0,0 +1,108 @@
+import fcntl
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+ROOP_PATH = os.environ.get('ROOP_PATH', '/opt/program/roop')
+if ROOP_PATH not in sys.path:
+    sys.path.insert(0, ROOP_PATH)
+
+import roop.globals
+from roop.core import decode_execution_providers
+from roop.face_analyser import get_face_analyser, get_one_face
+from roop.processors.frame import face_swapper
+from insightface.app.common import Face
+
+EXECUTION_PROVIDER = os.environ.get('ROOP_EXECUTION_PROVIDER', 'cuda')
+# Lowest detection confidence (0-1) of a source face hint that replaces the source detection
+SOURCE_HINT_MIN_SCORE = float(os.environ.get('SOURCE_HINT_MIN_SCORE', 0.9))
+MODEL_LOCK_PATH = '/tmp/roop-model.lock'
+
+
+class FaceSwapper:
+    """Keeps the insightface analyser and the inswapper model resident in the process.
+
+    The swap follows roop's image mode (``run.py`` with the default ``face_swapper``
+    frame processor): the first detected source face is pasted onto the first
+    detected target face, and the target is returned untouched if it has no face.
+    """
+
+    def __init__(self, execution_provider=EXECUTION_PROVIDER):
+        roop.globals.execution_providers = decode_execution_providers([execution_provider])
+        roop.globals.many_faces = False
+        roop.globals.reference_face_position = 0
+        roop.globals.similar_face_distance = 0.85
+
+        # gunicorn boots every worker at the same time; load one at a time so that
+        # only the first worker downloads inswapper_128.onnx and the buffalo_l models.
+        with open(MODEL_LOCK_PATH, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            face_swapper.pre_check()
+            self.analyser = get_face_analyser()
+            self.model = face_swapper.get_face_swapper()
+
+    def analyse(self, frame):
+        return get_one_face(frame, roop.globals.reference_face_position)
+
+    def swap(self, source_frame, target_frame):
+        return self.swap_face(source_frame, target_frame, self.analyse(target_frame))
+
+    def face_from_hint(self, frame, hint):
+        """Builds the source face from a detection done upstream, or None if the hint is unusable.
+
+        The hint is {'box': [x1, y1, x2, y2], 'kps': five [x, y] (eyes, nose, mouth corners), 'score': 0-1}
+        in frame pixels. Only the recognition model runs, for the embedding inswapper needs.
+        """
+        try:
+            bbox = np.asarray(hint['box'], dtype=np.float32).reshape(4)
+            kps = np.asarray(hint['kps'], dtype=np.float32).reshape(5, 2)
+            score = float(hint['score'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        height, width = frame.shape[:2]
+        inside = (kps >= 0).all() and (kps[:, 0] < width).all() and (kps[:, 1] < height).all()
+        if score < SOURCE_HINT_MIN_SCORE or not inside or bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+            return None
+
+        face = Face(bbox=bbox, kps=kps, det_score=score)
+        self.analyser.models['recognition'].get(frame, face)
+        return face
+
+    def source_face(self, source_frame, source_hint=None):
+        source_face = self.face_from_hint(source_frame, source_hint) if source_hint else None
+        if source_face is None:
+            source_face = self.analyse(source_frame)
+        if source_face is None:
+            raise ValueError("No face detected in the source image")
+        return source_face
+
+    def swap_face(self, source_frame, target_frame, target_face, source_hint=None):
+        return self.swap_faces(source_frame, [(target_frame, target_face)], source_hint)[0]
+
+    def swap_faces(self, source_frame, targets, source_hint=None):
+        # Each target is (target_frame, target_face), target_face from analyse(target_frame), possibly
+        # cached (see target_cache.py). The source face is analysed once and pasted onto every target.
+        source_face = self.source_face(source_frame, source_hint)
+        return [target_frame if target_face is None else self.model.get(target_frame, target_face, source_face, paste_back=True)
+                for target_frame, target_face in targets]
+
+
+def run_roop_subprocess(source_path, target_path, output_path):
+    # Legacy path: start roop's run.py for a single swap
+    command = [
+        "python", os.path.join(ROOP_PATH, "run.py"),
+        "--execution-provider", EXECUTION_PROVIDER,
+        "--source", source_path,
+        "--target", target_path,
+        "--output", output_path,
+        "--skip-audio"
+    ]
+
+    print(f"command: {command}")
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    while p.poll() == None:
+        out = p.stdout.readline()
+        print(out, end='')
@@ -0,0 +1,106 @@
+import fcntl
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from image_io import s3_client, get_s3_image, decode_image
+
+TARGET_CACHE_BUCKET = os.environ.get('TARGET_CACHE_BUCKET')
+TARGET_CACHE_PREFIX = os.environ.get('TARGET_CACHE_PREFIX', 'images/base/')
+# Optional directory that keeps analysed targets across container restarts
+TARGET_CACHE_DIR = os.environ.get('TARGET_CACHE_DIR')
+# How long the key -> ETag listing is trusted before the prefix is listed again
+TARGET_CACHE_REFRESH = int(os.environ.get('TARGET_CACHE_REFRESH', 300))
+
+
+class CachedTarget:
+    def __init__(self, image, face):
+        self.image = image
+        self.face = face
+
+
+class TargetFaceCache:
+    """Decoded base images and their analysed target face, keyed by S3 key and ETag.
+
+    The base images are a small fixed set, so only the source face has to be analysed per
+    request. ``analyse`` is the model's analyse method (a FaceSwapper or a ModelClient).
+    """
+
+    def __init__(self, analyse, cache_dir=TARGET_CACHE_DIR):
+        self.analyse = analyse
+        self.cache_dir = cache_dir
+        self.entries = {}
+        self.etags = {}
+        self.listed_at = 0
+        self.lock = threading.Lock()
+
+    def preload(self, bucket, prefix):
+        self.refresh_etags(bucket, prefix)
+        for key in self.etags:
+            if key.lower().endswith('.png'):
+                self.get(bucket, key)
+        print(f"Target face cache loaded {len(self.entries)} images from s3://{bucket}/{prefix}")
+
+    def refresh_etags(self, bucket, prefix):
+        etags = {}
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                etags[obj['Key']] = obj['ETag']
+        self.etags = etags
+        self.listed_at = time.monotonic()
+
+    def etag(self, bucket, key):
+        if time.monotonic() - self.listed_at > TARGET_CACHE_REFRESH and key.startswith(TARGET_CACHE_PREFIX):
+            self.refresh_etags(bucket, TARGET_CACHE_PREFIX)
+        if key not in self.etags:
+            self.etags[key] = s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+        return self.etags[key]
+
+    def get(self, bucket, key):
+        cache_key = (bucket, key, self.etag(bucket, key))
+        entry = self.entries.get(cache_key)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.get(cache_key) or self.load(cache_key)
+                self.entries[cache_key] = entry
+        return entry
+
+    def load(self, cache_key):
+        path = self.disk_path(cache_key)
+        if path is None:
+            return self.analyse_target(cache_key)
+
+        # Workers share the on-disk store; the first one to get the lock analyses the target
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f"{path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                with open(path, 'rb') as file:
+                    image, face = pickle.load(file)
+                return self.freeze(image, face)
+
+            entry = self.analyse_target(cache_key)
+            with open(f"{path}.tmp", 'wb') as file:
+                pickle.dump((entry.image, entry.face), file)
+            os.replace(f"{path}.tmp", path)
+            return entry
+
+    def analyse_target(self, cache_key):
+        bucket, key, _ = cache_key
+        image = decode_image(get_s3_image(bucket, key))
+        return self.freeze(image, self.analyse(image))
+
+    def disk_path(self, cache_key):
+        if not self.cache_dir:
+            return None
+        digest = hashlib.sha256(repr(cache_key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.pkl")
+
+    @staticmethod
+    def freeze(image, face):
+        # Cached arrays are shared by every request; fail loudly instead of corrupting them
+        image.setflags(write=False)
+        return CachedTarget(image, face)
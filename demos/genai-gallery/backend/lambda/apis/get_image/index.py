@@ -1,32 +1,139 @@
+import base64
 import boto3
 import json
 import os
-from typing import Dict, Any
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, Any, List, Optional, Set, Tuple
 
 s3_client = boto3.client('s3')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
 OBJECT_PATH = os.environ.get('OBJECT_PATH')
 PRESIGNED_URL_TTL = int(os.environ.get('PRESIGNED_URL_TTL', 1800))
+JOB_TABLE_NAME = os.environ.get('JOB_TABLE_NAME')
+# Longest a request waits for the job state to change; API Gateway ends integrations at 29 seconds
+MAX_WAIT_SECONDS = int(os.environ.get('MAX_WAIT_SECONDS', 20))
+POLL_INTERVAL_SECONDS = 1
+
+job_table = boto3.resource('dynamodb').Table(JOB_TABLE_NAME) if JOB_TABLE_NAME else None
+
+# With result_cdn the results are served by CloudFront instead of presigned S3 URLs
+CDN_DOMAIN_NAME = os.environ.get('CDN_DOMAIN_NAME')
+
+# Before these states there is no result to look for in S3
+PENDING_STATES = ['uploading', 'detecting', 'failed']
+FINAL_STATES = ['completed', 'failed']
+
+# Gallery listing: indexes of completed jobs by event and by batch, newest first
+EVENT_INDEX_NAME = 'event-index'
+BATCH_INDEX_NAME = 'batch-index'
+DEFAULT_EVENT_ID = 'default'
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+# Renditions written next to each result, smallest first; 'original' is the PNG at {uuid}.png
+SIZES = ['thumb', 'screen', 'original']
+FORMATS = ['webp', 'avif', 'png']
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if event.get('resource') == '/apis/images':
+        return list_images(event)
+
     try:
         uuid = event['pathParameters']['uuid']
         if not uuid:
             return create_response(400, {'error': 'Invalid request: Missing UUID'})
 
-        object_key = f"{OBJECT_PATH}{uuid}.png"
-        presigned_url = generate_presigned_url(object_key)
+        query = event.get('queryStringParameters') or {}
+        size = query.get('size', 'original')
+        image_format = query.get('format', 'webp')
+        if size not in SIZES or image_format not in FORMATS:
+            return create_response(400, {'error': f"Invalid request: size must be one of {SIZES} and format one of {FORMATS}"})
+        try:
+            wait = min(max(int(query.get('wait', 0)), 0), MAX_WAIT_SECONDS)
+        except ValueError:
+            return create_response(400, {'error': 'Invalid request: wait must be a number of seconds'})
 
-        return create_response(200, {
-            'downloadUrl': presigned_url,
-            'uuid': uuid
-        })
+        # 'state' and 'result' are what the client already knows; the request returns once either changes
+        job = wait_for_job(uuid, size, image_format, query.get('state'), query.get('result'), wait)
+
+        body = {'uuid': uuid, 'state': job['state'], 'timings': job['timings']}
+        if job.get('error'):
+            body['failureReason'] = job['error']
+        if job.get('result_key'):
+            body['downloadUrl'] = generate_download_url(job['result_key'])
+            body['key'] = job['result_key']
+            # 'preview' is a low-resolution image of the swap, to be replaced once the 'final' one exists
+            body['resultType'] = job['result_type']
+        return create_response(200, body)
 
     except KeyError:
         return create_response(400, {'error': 'Invalid request: Missing path parameters'})
     except Exception as e:
         return create_response(500, {'error': f'Internal server error: {str(e)}'})
 
+def list_images(event: Dict[str, Any]) -> Dict[str, Any]:
+    query = event.get('queryStringParameters') or {}
+    # A batch belongs to one event, so the batch filter alone is enough
+    if query.get('batch'):
+        index_name, partition = BATCH_INDEX_NAME, ('batch_id', query['batch'])
+    else:
+        index_name, partition = EVENT_INDEX_NAME, ('event_id', query.get('event', DEFAULT_EVENT_ID))
+
+    try:
+        limit = int(query.get('limit', DEFAULT_PAGE_SIZE))
+        start_key = decode_cursor(query['cursor'], partition) if query.get('cursor') else None
+    except ValueError:
+        return create_response(400, {'error': 'Invalid request: limit must be a number and cursor the nextCursor of a previous page'})
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return create_response(400, {'error': f"Invalid request: limit must be between 1 and {MAX_PAGE_SIZE}"})
+
+    try:
+        parameters = {
+            'IndexName': index_name,
+            'KeyConditionExpression': '#partition = :partition',
+            'ExpressionAttributeNames': {'#partition': partition[0]},
+            'ExpressionAttributeValues': {':partition': partition[1]},
+            'ScanIndexForward': False,
+            'Limit': limit
+        }
+        if start_key:
+            parameters['ExclusiveStartKey'] = start_key
+        response = job_table.query(**parameters)
+
+        body = {
+            'items': [{
+                'uuid': item['uuid'],
+                'completedAt': int(item['completed_at']),
+                'thumbnailUrl': generate_download_url(item['thumb_key']),
+                'key': item['result_key']
+            } for item in response['Items']],
+            'nextCursor': encode_cursor(response['LastEvaluatedKey']) if 'LastEvaluatedKey' in response else None
+        }
+        return create_response(200, body)
+
+    except Exception as e:
+        return create_response(500, {'error': f'Internal server error: {str(e)}'})
+
+def encode_cursor(last_evaluated_key: Dict[str, Any]) -> str:
+    # The key of the last item on the page, opaque to the client
+    key = {name: int(value) if isinstance(value, Decimal) else value for name, value in last_evaluated_key.items()}
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor: str, partition: Tuple[str, str]) -> Dict[str, Any]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    # DynamoDB rejects an ExclusiveStartKey that is not a key of the queried index and partition
+    key_types = {'uuid': str, partition[0]: str, 'completed_at': int}
+    if (not isinstance(key, dict) or set(key) != set(key_types)
+            or any(type(key[name]) is not key_type for name, key_type in key_types.items())
+            or key[partition[0]] != partition[1]):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return key
+
 def create_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
     return {
         'statusCode': status_code,
@@ -37,6 +144,76 @@ def create_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
         }
     }
 
+def wait_for_job(uuid: str, size: str, image_format: str, known_state: Optional[str], known_result: Optional[str], wait: int) -> Dict[str, Any]:
+    deadline = time.monotonic() + wait
+    while True:
+        job = get_job(uuid, size, image_format)
+        # Clients that do not send 'result' ('' while they have none) only wait for state changes
+        changed = job['state'] != known_state or (known_result is not None and job.get('result_type', '') != known_result)
+        if changed or job['state'] in FINAL_STATES or time.monotonic() >= deadline:
+            return job
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+def get_job(uuid: str, size: str, image_format: str) -> Dict[str, Any]:
+    item = job_table.get_item(Key={'uuid': uuid}, ConsistentRead=True).get('Item', {}) if job_table else {}
+    job = {
+        'state': item.get('state', 'unknown'),
+        'error': item.get('error'),
+        'timings': {name[:-len('_seconds')]: float(value) for name, value in item.items() if name.endswith('_seconds')}
+    }
+
+    # Asynchronous endpoints do not report when they finish, so the result in S3 is what completes a job
+    if job['state'] not in PENDING_STATES:
+        existing = list_results(uuid)
+        result_key = next((key for key in variant_keys(uuid, size, image_format) if key in existing), None)
+        preview_key = f"{OBJECT_PATH}{uuid}.preview.webp"
+        if result_key:
+            job.update(state='completed', result_key=result_key, result_type='final')
+        elif preview_key in existing:
+            job.update(result_key=preview_key, result_type='preview')
+    return job
+
+def variant_keys(uuid: str, size: str, image_format: str) -> List[str]:
+    # The requested size in the requested format first, then its other formats, then the larger sizes
+    keys = []
+    for variant in SIZES[SIZES.index(size):]:
+        if variant == 'original':
+            keys.append(f"{OBJECT_PATH}{uuid}.png")
+        else:
+            formats = sorted(['webp', 'avif'], key=lambda f: f != image_format)
+            keys.extend(f"{OBJECT_PATH}{uuid}.{variant}.{f}" for f in formats)
+    return keys
+
+def list_results(uuid: str) -> Set[str]:
+    # One listing returns every rendition of the result and its preview, or nothing while they are being produced
+    response = s3_client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=f"{OBJECT_PATH}{uuid}.")
+    return {obj['Key'] for obj in response.get('Contents', [])}
+
+def create_cloudfront_signer() -> Any:
+    # cryptography comes from a layer that is only attached with result_cdn
+    from botocore.signers import CloudFrontSigner
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    secret = boto3.client('secretsmanager').get_secret_value(SecretId=os.environ['CDN_PRIVATE_KEY_SECRET'])
+    private_key = serialization.load_pem_private_key(secret['SecretString'].encode(), password=None)
+    # CloudFront only accepts SHA-1 RSA signatures
+    return CloudFrontSigner(os.environ['CDN_KEY_PAIR_ID'], lambda message: private_key.sign(message, padding.PKCS1v15(), hashes.SHA1()))
+
+cloudfront_signer = create_cloudfront_signer() if CDN_DOMAIN_NAME else None
+
+def generate_download_url(object_key: str) -> str:
+    if cloudfront_signer is None:
+        return generate_presigned_url(object_key)
+
+    # Rounding the expiry keeps the URL identical for a whole TTL window, so browsers reuse their cached copy.
+    # Every URL stays valid for between one and two TTLs.
+    expires = (int(time.time()) // PRESIGNED_URL_TTL + 2) * PRESIGNED_URL_TTL
+    return cloudfront_signer.generate_presigned_url(
+        f"https://{CDN_DOMAIN_NAME}/{object_key}",
+        date_less_than=datetime.fromtimestamp(expires, timezone.utc)
+    )
+
 def generate_presigned_url(object_key: str) -> str:
     return s3_client.generate_presigned_url(
         'get_object',
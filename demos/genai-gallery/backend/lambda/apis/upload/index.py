@@ -2,13 +2,25 @@ import boto3
 import json
 import uuid
 import os
+import re
+import time
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 s3_client = boto3.client('s3')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
 OBJECT_PATH = os.environ.get('OBJECT_PATH')
 PRESIGNED_URL_TTL = int(os.environ.get('PRESIGNED_URL_TTL', 300))
+JOB_TABLE_NAME = os.environ.get('JOB_TABLE_NAME')
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 7 * 24 * 3600))
+# Gallery event an upload belongs to; the listing API filters by it
+EVENT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+DEFAULT_EVENT_ID = 'default'
+# Batch uploads: most upload targets per call, and the largest object each target accepts
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 20))
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+
+job_table = boto3.resource('dynamodb').Table(JOB_TABLE_NAME) if JOB_TABLE_NAME else None
 
 def create_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
     return {
@@ -32,11 +44,64 @@ def generate_presigned_url(object_key: str) -> str:
         ExpiresIn=PRESIGNED_URL_TTL
     )
 
+def generate_presigned_post(object_key: str, batch_id: str) -> Dict[str, Any]:
+    # Unlike a presigned PUT, a POST policy can limit the size of the uploaded object
+    return s3_client.generate_presigned_post(
+        Bucket=BUCKET_NAME,
+        Key=object_key,
+        Fields={'Content-Type': 'image/png', 'x-amz-meta-batch-id': batch_id},
+        Conditions=[
+            {'Content-Type': 'image/png'},
+            {'x-amz-meta-batch-id': batch_id},
+            ['content-length-range', 1, MAX_UPLOAD_BYTES]
+        ],
+        ExpiresIn=PRESIGNED_URL_TTL
+    )
+
+def new_job(job_uuid: str, event_id: str, batch_id: Optional[str] = None) -> Dict[str, Any]:
+    # The pipeline stages update this record as the upload moves through them
+    now = int(time.time())
+    item = {
+        'uuid': job_uuid,
+        'event_id': event_id,
+        'state': 'uploading',
+        'created_at': now,
+        'updated_at': now,
+        'expires_at': now + JOB_TTL_SECONDS
+    }
+    if batch_id:
+        item['batch_id'] = batch_id
+    return item
+
+def create_job(job_uuid: str, event_id: str) -> None:
+    if job_table is None:
+        return
+    job_table.put_item(Item=new_job(job_uuid, event_id))
+
+def create_batch_jobs(job_uuids: List[str], event_id: str, batch_id: str) -> None:
+    if job_table is None:
+        return
+    with job_table.batch_writer() as batch:
+        for job_uuid in job_uuids:
+            batch.put_item(Item=new_job(job_uuid, event_id, batch_id))
+
+def get_event_id(event: Dict[str, Any]) -> Optional[str]:
+    event_id = (event.get('queryStringParameters') or {}).get('event', DEFAULT_EVENT_ID)
+    return event_id if EVENT_ID_PATTERN.match(event_id) else None
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if event.get('resource', '').endswith('/batch'):
+        return batch_handler(event)
+
+    event_id = get_event_id(event)
+    if event_id is None:
+        return create_response(400, {'error': 'Invalid request: event must be 1-64 letters, digits, - or _'})
+
     try:
         file_uuid = generate_unique_id()
         object_key = f"{OBJECT_PATH}{file_uuid}"
         presigned_url = generate_presigned_url(object_key)
+        create_job(file_uuid[:-4], event_id)
 
         return create_response(200, {
             'uploadUrl': presigned_url,
@@ -44,4 +109,39 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         })
 
     except Exception as e:
-        return create_response(500, {'error': f'Internal server error: {str(e)}'})
\ No newline at end of file
+        return create_response(500, {'error': f'Internal server error: {str(e)}'})
+
+def batch_handler(event: Dict[str, Any]) -> Dict[str, Any]:
+    query = event.get('queryStringParameters') or {}
+    try:
+        count = int(query.get('count', 1))
+    except ValueError:
+        count = 0
+    if not 1 <= count <= MAX_BATCH_SIZE:
+        return create_response(400, {'error': f'Invalid request: count must be between 1 and {MAX_BATCH_SIZE}'})
+    event_id = get_event_id(event)
+    if event_id is None:
+        return create_response(400, {'error': 'Invalid request: event must be 1-64 letters, digits, - or _'})
+
+    try:
+        batch_id = str(uuid.uuid4())
+        uploads = []
+        for _ in range(count):
+            file_uuid = generate_unique_id()
+            presigned_post = generate_presigned_post(f"{OBJECT_PATH}{file_uuid}", batch_id)
+            uploads.append({
+                'uuid': file_uuid[:-4],
+                'uploadUrl': presigned_post['url'],
+                'fields': presigned_post['fields']
+            })
+        create_batch_jobs([upload['uuid'] for upload in uploads], event_id, batch_id)
+
+        return create_response(200, {
+            'batchId': batch_id,
+            'maxUploadBytes': MAX_UPLOAD_BYTES,
+            'expiresIn': PRESIGNED_URL_TTL,
+            'uploads': uploads
+        })
+
+    except Exception as e:
+        return create_response(500, {'error': f'Internal server error: {str(e)}'})
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Duration, peak memory and output size of the face_detection stage on a 12 MP phone photo:
+#   previous  deepcopy and full-size JPEG re-encode for Rekognition, full-resolution crop
+#   uncapped  reduced detection image, full-resolution crop (MAX_FACE_EDGE=0)
+#   current   reduced detection image, crop capped at MAX_FACE_EDGE
+# Rekognition is replaced by a fixed response, so only the image work is measured:
+#
+#   python benchmark.py --iterations 10
+#   python benchmark.py --image photo.jpg --save-crops /tmp/crops
+#
+# Each variant runs in its own process so that the peak RSS of one does not hide the other.
+# The saved crops can be fed to the roop container's benchmark.py (--source) to compare the
+# downstream stages on a GPU instance.
+
+import argparse
+import copy
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+# The Lambda gets pipeline_common from its layer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layers', 'pipeline_common', 'python'))
+
+import index
+
+FACE_DETAILS = {'FaceDetails': [{'BoundingBox': {'Left': 0.4, 'Top': 0.3, 'Width': 0.2, 'Height': 0.25}}]}
+
+
+class FakeRekognition:
+    def detect_faces(self, Image, Attributes):
+        return FACE_DETAILS
+
+
+def synthetic_photo(width=4032, height=3024):
+    # Smooth gradients plus sensor-like noise compress to the size of a real phone JPEG
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    rng = np.random.default_rng(0)
+    channels = [128 + 100 * np.sin(x / 300 + phase) * np.cos(y / 200) for phase in (0, 1, 2)]
+    pixels = np.stack(channels, axis=-1) + rng.normal(0, 6, (height, width, 3))
+    buffer = BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format='jpeg', quality=92)
+    return buffer.getvalue()
+
+
+def previous(image_bytes):
+    image = Image.open(BytesIO(image_bytes))
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+    imgWidth, imgHeight = image.size
+    ori_image = copy.deepcopy(image)
+
+    buffer = BytesIO()
+    image.save(buffer, format='jpeg')
+    response = index.rekognition_client.detect_faces(Image={'Bytes': buffer.getvalue()}, Attributes=['ALL'])
+
+    box = response['FaceDetails'][0]['BoundingBox']
+    left, top = imgWidth * box['Left'], imgHeight * box['Top']
+    width, height = imgWidth * box['Width'], imgHeight * box['Height']
+    box = (int(max(0, left - width / 2)), int(max(0, top - height / 2)),
+           int(min(imgWidth, left + width * 1.5)), int(min(imgHeight, top + height * 1.5)))
+    return encode(ori_image.crop(box))
+
+
+def current(image_bytes):
+    return encode(index.crop_largest_face(image_bytes)[0])
+
+
+def encode(image):
+    buffered = BytesIO()
+    image.save(buffered, format='png')
+    return buffered.getvalue()
+
+
+VARIANTS = {'previous': previous, 'uncapped': current, 'current': current}
+
+
+def measure(name, image_bytes, iterations, save_dir, results):
+    index.rekognition_client = FakeRekognition()
+    if name == 'uncapped':
+        index.MAX_FACE_EDGE = 0
+    variant = VARIANTS[name]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        output = variant(image_bytes)
+        samples.append(time.perf_counter() - start)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    with Image.open(BytesIO(output)) as image:
+        size = image.size
+    if save_dir:
+        with open(os.path.join(save_dir, f"{name}.png"), 'wb') as file:
+            file.write(output)
+    results[name] = (statistics.median(samples), max(samples), peak / 1024, size, len(output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='face_detection preprocessing duration and peak memory')
+    parser.add_argument('--image', help='JPEG/PNG to use instead of a synthetic 12 MP photo')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--save-crops', help='directory to write the crop of each variant to')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    if args.image:
+        with open(args.image, 'rb') as file:
+            image_bytes = file.read()
+    else:
+        # Linux keeps ru_maxrss across exec, so the children would inherit the peak of generating it here
+        with context.Pool(1) as pool:
+            image_bytes = pool.apply(synthetic_photo)
+    with Image.open(BytesIO(image_bytes)) as image:
+        print(f"input: {image.format} {image.size[0]}x{image.size[1]}, {len(image_bytes) / 1e6:.1f} MB")
+
+    if args.save_crops:
+        os.makedirs(args.save_crops, exist_ok=True)
+
+    results = context.Manager().dict()
+    for name in VARIANTS:
+        process = context.Process(target=measure, args=(name, image_bytes, args.iterations, args.save_crops, results))
+        process.start()
+        process.join()
+
+    for name in VARIANTS:
+        p50, worst, peak_mb, (width, height), output_bytes = results[name]
+        print(f"{name:<9} p50={p50 * 1000:8.1f} ms max={worst * 1000:8.1f} ms peak_rss=+{peak_mb:7.1f} MB "
+              f"crop={width}x{height} png={output_bytes / 1e6:.2f} MB")
+
+
+if __name__ == '__main__':
+    main()
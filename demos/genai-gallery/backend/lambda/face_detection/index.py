@@ -1,77 +1,207 @@
 import boto3
-import copy
+import numpy as np
 from PIL import Image
 from io import BytesIO
+import hashlib
 import urllib.parse
 import json
+import math
 import os
+import time
+
+from pipeline_common.formats import OUTPUT_FORMAT, image_key
+from pipeline_common.job_status import update_job
+from pipeline_common.records import process_records, create_batch_response
 
 s3_client = boto3.client('s3')
 REGION = os.environ.get('REGION', 'us-east-1')
 rekognition_client = boto3.client('rekognition', region_name=REGION)
 
-MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
+# Longest edge of the image sent to detection; face boxes are relative, so they apply to the original as is
+DETECTION_MAX_EDGE = int(os.environ.get('DETECTION_MAX_EDGE', 1600))
+# 'rekognition' calls Amazon Rekognition, 'opencv' runs the Haar cascade from the OpenCV layer in the Lambda
+FACE_DETECTOR = os.environ.get('FACE_DETECTOR', 'rekognition')
+# Longest edge of the saved face crop (0 keeps full resolution); roop only reads the source face and GFPGAN works at 512 px
+MAX_FACE_EDGE = int(os.environ.get('MAX_FACE_EDGE', 512))
+# Rekognition landmarks that make up the source face hint for roop
+HINT_LANDMARKS = ['eyeLeft', 'eyeRight', 'nose', 'mouthLeft', 'mouthRight']
 
 def lambda_handler(event, context):
-    s3_event = event['Records'][0]['s3']
+    results = process_records(event['Records'], 'detect', process_record)
+    failed = sum(1 for result in results if result['statusCode'] >= 500)
+    if failed:
+        # Raise so that Lambda retries the event; the records that succeeded are claimed and skipped then
+        raise RuntimeError(f"{failed} of {len(results)} records failed: {json.dumps(results)}")
+    return create_batch_response(results)
+
+def process_record(record):
+    s3_event = record['s3']
     bucket_name = s3_event['bucket']['name']
     encoded_object_key = s3_event['object']['key']
     source_object_key = urllib.parse.unquote_plus(encoded_object_key)
     source_filename = os.path.basename(source_object_key)
-    output_object_key = f"{os.environ['OUTPUT_PATH']}{source_filename}"
-    
-    # S3에서 이미지 파일을 로드
-    response = s3_client.get_object(Bucket=bucket_name, Key=source_object_key)
-    image = Image.open(response['Body'])
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
-    
-    # Rekognition으로 가장 큰 얼굴 영역 추출
-    cropped_image, width, height, f_left, f_top, f_width, f_height, _ = show_faces(image, bucket_name, source_object_key)
+    uuid = os.path.splitext(source_filename)[0]
+    output_object_key = image_key(os.environ['OUTPUT_PATH'], uuid, OUTPUT_FORMAT)
+    start_time = time.time()
+    update_job(uuid, 'detecting')
     
-    if cropped_image is not None:
-        # 추출한 얼굴 영역을 새로운 이미지로 저장
-        cropped_image = cropped_image.crop((f_left, f_top, f_left + f_width, f_top + f_height))
+    try:
+        # S3에서 이미지 파일을 로드
+        response = s3_client.get_object(Bucket=bucket_name, Key=source_object_key)
+        image_bytes = response['Body'].read()
         
-        # 추출한 이미지를 S3에 저장
-        buffered = BytesIO()
-        cropped_image.save(buffered, format="png")
-        image_bytes = buffered.getvalue()
-        s3_client.put_object(Bucket=bucket_name, Key=output_object_key, Body=image_bytes)
+        # 가장 큰 얼굴 영역 추출
+        cropped_image, scale, hint = crop_largest_face(image_bytes)
         
+        if cropped_image is not None:
+            # 추출한 이미지를 S3에 저장
+            image_bytes, content_type = encode_image(cropped_image, OUTPUT_FORMAT)
+            # The roop stage looks up earlier results of the same crop by this hash
+            metadata = {'face-scale': f"{scale:.6f}", 'content-hash': hashlib.sha256(image_bytes).hexdigest()}
+            if hint:
+                # The roop predictor uses the detection instead of detecting the source face again
+                metadata['face-hint'] = json.dumps(hint, separators=(',', ':'))
+            s3_client.put_object(Bucket=bucket_name, Key=output_object_key, Body=image_bytes, ContentType=content_type,
+                                 Metadata=metadata)
+    except Exception as e:
+        update_job(uuid, 'failed', error=str(e))
+        raise
+    
+    if cropped_image is not None:
+        update_job(uuid, None, 'detect', time.time() - start_time)
         return {
             'statusCode': 200,
             'body': json.dumps('Cropped face image saved successfully!')
         }
     else:
+        update_job(uuid, 'failed', 'detect', time.time() - start_time, error='No faces detected in the image.')
         return {
             'statusCode': 200,
             'body': json.dumps('No faces detected in the image.')
         }
 
-def show_faces(image, bucket_name, object_key, padding_ratio=0.5):
+def crop_largest_face(image_bytes, padding_ratio=0.5):
+    # Image.open only parses the header; the full-resolution pixels are decoded at most once
+    image = Image.open(BytesIO(image_bytes))
     imgWidth, imgHeight = image.size
-    ori_image = copy.deepcopy(image)
-    
-    # 이미지 크기 확인 및 필요시 압축
-    buffer = BytesIO()
-    image.save(buffer, format='jpeg')
-    image_bytes = buffer.getvalue()
-
-    if len(image_bytes) > MAX_IMAGE_SIZE:
-        print(f"Image size exceeds {MAX_IMAGE_SIZE} bytes. Using S3 object reference.")
-        response = rekognition_client.detect_faces(
-            Image={'S3Object': {'Bucket': bucket_name, 'Name': object_key}},
-            Attributes=['ALL']
-        )
+    face_box, face = show_faces(image, image_bytes, padding_ratio)
+    if face_box is None:
+        return None, None, None
+
+    f_left, f_top, f_width, f_height = face_box
+    scale = 1.0
+    if MAX_FACE_EDGE and max(f_width, f_height) > MAX_FACE_EDGE:
+        scale = MAX_FACE_EDGE / max(f_width, f_height)
+        # JPEG: decode at the smallest draft scale that keeps the crop at least MAX_FACE_EDGE (a no-op for other formats)
+        image.draft('RGB', (math.ceil(image.size[0] * scale), math.ceil(image.size[1] * scale)))
+
+    # crop reads the decoded pixels directly, only the face region is copied
+    decoded_scale = image.size[0] / imgWidth
+    cropped_image = image.crop(tuple(int(v * decoded_scale) for v in (f_left, f_top, f_left + f_width, f_top + f_height)))
+    if cropped_image.mode == 'RGBA':
+        cropped_image = cropped_image.convert('RGB')
+    if scale < 1:
+        # reducing_gap shrinks by an integer factor first, then LANCZOS resamples the small remainder
+        size = (max(1, round(f_width * scale)), max(1, round(f_height * scale)))
+        cropped_image = cropped_image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    return cropped_image, scale, face_hint(face, (imgWidth, imgHeight), face_box, cropped_image.size)
+
+def face_hint(face, image_size, face_box, crop_size):
+    # Box, five landmarks and confidence of the face in crop pixels, in insightface's layout:
+    # eyes, nose and mouth corners, each pair left to right in the image
+    landmarks = face.get('Landmarks', {})
+    if not all(name in landmarks for name in HINT_LANDMARKS):
+        return None
+
+    imgWidth, imgHeight = image_size
+    f_left, f_top, f_width, f_height = face_box
+    scale_x, scale_y = crop_size[0] / f_width, crop_size[1] / f_height
+
+    def to_crop(x, y):
+        return [round((imgWidth * x - f_left) * scale_x, 1), round((imgHeight * y - f_top) * scale_y, 1)]
+
+    eyes = sorted(to_crop(*landmarks[name]) for name in ('eyeLeft', 'eyeRight'))
+    mouth = sorted(to_crop(*landmarks[name]) for name in ('mouthLeft', 'mouthRight'))
+    top_left = to_crop(face['Left'], face['Top'])
+    bottom_right = to_crop(face['Left'] + face['Width'], face['Top'] + face['Height'])
+    return {
+        'box': top_left + bottom_right,
+        'kps': eyes + [to_crop(*landmarks['nose'])] + mouth,
+        'score': round(face['Confidence'], 4)
+    }
+
+def encode_image(image, image_format):
+    buffered = BytesIO()
+    if image_format == 'npy':
+        # Raw BGR array, the layout the predictors decode images into with OpenCV
+        np.save(buffered, np.ascontiguousarray(np.asarray(image.convert('RGB'))[:, :, ::-1]), allow_pickle=False)
+        return buffered.getvalue(), 'application/x-npy'
+    if image_format == 'webp':
+        image.save(buffered, format='webp', lossless=True, method=0, quality=0)
+        return buffered.getvalue(), 'image/webp'
+
+    # Pillow's default level 6 spends several times longer than level 1 for a few percent smaller files
+    image.save(buffered, format='png', compress_level=1 if image_format == 'png-fast' else 6)
+    return buffered.getvalue(), 'image/png'
+
+def reduced_image(image, image_bytes):
+    factor = -(-max(image.size) // DETECTION_MAX_EDGE)
+    if image.format == 'JPEG':
+        # Draft mode decodes at 1/2, 1/4 or 1/8 scale, so the full-size pixels are never decoded here
+        detection_image = Image.open(BytesIO(image_bytes))
+        detection_image.draft('RGB', (image.size[0] // factor, image.size[1] // factor))
+        factor = -(-max(detection_image.size) // DETECTION_MAX_EDGE)
     else:
-        response = rekognition_client.detect_faces(Image={'Bytes': image_bytes}, Attributes=['ALL'])
+        # Other formats have no reduced-scale decoding; reduce the original, which the crop decodes anyway
+        detection_image = image if image.mode in ('RGB', 'RGBA', 'L') else image.convert('RGB')
+    if factor > 1:
+        detection_image = detection_image.reduce(factor)
+    if detection_image.mode not in ('RGB', 'L'):
+        detection_image = detection_image.convert('RGB')
+    return detection_image
+
+def detect_faces_rekognition(detection_image):
+    buffer = BytesIO()
+    detection_image.save(buffer, format='jpeg', quality=90)
+
+    # The default attributes include the bounding box, confidence and the five landmarks the roop hint needs
+    response = rekognition_client.detect_faces(Image={'Bytes': buffer.getvalue()}, Attributes=['DEFAULT'])
+    return [{
+        **faceDetail['BoundingBox'],
+        'Confidence': faceDetail.get('Confidence', 0) / 100,
+        'Landmarks': {landmark['Type']: (landmark['X'], landmark['Y']) for landmark in faceDetail.get('Landmarks', [])}
+    } for faceDetail in response['FaceDetails']]
+
+face_cascade = None
+
+def detect_faces_opencv(detection_image):
+    # cv2 comes from the OpenCV layer, which is only attached when FACE_DETECTOR is 'opencv'
+    import cv2
+
+    global face_cascade
+    if face_cascade is None:
+        face_cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml'))
+
+    gray = np.asarray(detection_image.convert('L'))
+    imgHeight, imgWidth = gray.shape
+    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(40, 40))
+    # Same relative box format as Rekognition; the Haar cascade finds no landmarks, so there is no roop hint
+    return [{'Left': x / imgWidth, 'Top': y / imgHeight, 'Width': w / imgWidth, 'Height': h / imgHeight} for x, y, w, h in faces]
+
+FACE_DETECTORS = {
+    'rekognition': detect_faces_rekognition,
+    'opencv': detect_faces_opencv
+}
+
+def show_faces(image, image_bytes, padding_ratio=0.5):
+    imgWidth, imgHeight = image.size
+    boxes = FACE_DETECTORS[FACE_DETECTOR](reduced_image(image, image_bytes))
     
     largest_area = 0
     largest_face_box = None
+    largest_face = None
     
-    for faceDetail in response['FaceDetails']:
-        box = faceDetail['BoundingBox']
+    for box in boxes:
         left = imgWidth * box['Left']
         top = imgHeight * box['Top']
         width = imgWidth * box['Width']
@@ -82,6 +212,7 @@ def show_faces(image, bucket_name, object_key, padding_ratio=0.5):
         if current_area > largest_area:
             largest_area = current_area
             largest_face_box = (left, top, width, height)
+            largest_face = box
     
     if largest_face_box:
         left, top, width, height = largest_face_box
@@ -93,6 +224,6 @@ def show_faces(image, bucket_name, object_key, padding_ratio=0.5):
         padded_right = min(imgWidth, left + width + padding_width)
         padded_bottom = min(imgHeight, top + height + padding_height)
         
-        return ori_image, imgWidth, imgHeight, int(padded_left), int(padded_top), int(padded_right - padded_left), int(padded_bottom - padded_top), response
+        return (int(padded_left), int(padded_top), int(padded_right - padded_left), int(padded_bottom - padded_top)), largest_face
     else:
-        return None, None, None, None, None, None, None, None
+        return None, None
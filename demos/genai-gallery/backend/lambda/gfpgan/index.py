@@ -1,36 +1,55 @@
 import json
-import boto3
 import os
-import time
 import urllib.parse
 from typing import Dict, Any
 
-# Initialize AWS clients
-sagemaker_runtime = boto3.client('sagemaker-runtime')
-s3_client = boto3.client('s3')
+from pipeline_common.endpoint import ENDPOINT_MODE, get_endpoint, new_inference_id, timed_invoke, is_completion_notification, read_completion, completion_uuid
+from pipeline_common.formats import OUTPUT_FORMAT, image_key
+from pipeline_common.job_status import update_job
+from pipeline_common.records import handle_event
 
-# Constants
-MAX_WAIT_TIME = 30  # Maximum wait time in seconds
-CHECK_INTERVAL = 1  # Time between checks in seconds
+endpoint = get_endpoint()
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return handle_event(event, 'restore', process_record)
+
+def process_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    input_data = None
     try:
-        input_data = prepare_input_data(event)
-        invoke_sagemaker_endpoint(input_data)
-        output_url = wait_for_output_file(input_data['bucket'], input_data['output'])
+        input_data = prepare_input_data(record)
+        update_job(input_data['uuid'], 'restoring')
+
+        if ENDPOINT_MODE == 'async':
+            # result_index completes the job once the restored image lands in S3; failures arrive on the error topic
+            output_location = endpoint.invoke_async(input_data, new_inference_id(input_data['uuid']))
+            return create_accepted_response(output_location)
+
+        response, processing_time = timed_invoke(endpoint, input_data)
+        output_url = get_output_url(response, processing_time)
+        update_job(input_data['uuid'], 'completed', 'restore', processing_time, result_key=response['output'])
         return create_success_response(output_url)
     except Exception as e:
         print(f"Error processing request: {str(e)}")
+        # A failed inference has no input data, only the inferenceId of its notification
+        uuid = input_data['uuid'] if input_data else completion_uuid(record)
+        if uuid:
+            update_job(uuid, 'failed', error=str(e))
         return create_error_response(str(e))
 
-def prepare_input_data(event: Dict[str, Any]) -> Dict[str, str]:
-    s3_event = event['Records'][0]['s3']
-    bucket_name = s3_event['bucket']['name']
-    encoded_object_key = s3_event['object']['key']
-    source_object_key = urllib.parse.unquote_plus(encoded_object_key)
+def prepare_input_data(record: Dict[str, Any]) -> Dict[str, str]:
+    if is_completion_notification(record):
+        # Async mode: the roop endpoint finished, restore the image it wrote
+        roop_response = read_completion(record)
+        bucket_name = roop_response['bucket']
+        source_object_key = roop_response['output']
+    else:
+        s3_event = record['s3']
+        bucket_name = s3_event['bucket']['name']
+        encoded_object_key = s3_event['object']['key']
+        source_object_key = urllib.parse.unquote_plus(encoded_object_key)
     source_filename = os.path.basename(source_object_key)
-    output_object_key = f"{os.environ['OUTPUT_PATH']}{source_filename}"
     uuid = os.path.splitext(source_filename)[0]
+    output_object_key = image_key(os.environ['OUTPUT_PATH'], uuid, OUTPUT_FORMAT)
     
     return {
         'uuid': uuid,
@@ -39,31 +58,14 @@ def prepare_input_data(event: Dict[str, Any]) -> Dict[str, str]:
         'output': output_object_key
     }
 
-def invoke_sagemaker_endpoint(input_data: Dict[str, str]) -> None:
-    sagemaker_runtime.invoke_endpoint(
-        EndpointName=os.environ['SAGEMAKER_ENDPOINT_NAME'],
-        ContentType='application/json',
-        Body=json.dumps(input_data)
-    )
+def get_output_url(response: Dict[str, Any], processing_time: float) -> str:
+    # invoke_endpoint returns after the predictor has uploaded the output
+    if response.get('status') != 'completed':
+        raise RuntimeError(f"Endpoint did not complete the request: {response}")
 
-def wait_for_output_file(bucket: str, output_key: str) -> str:
-    start_time = time.time()
-    
-    while True:
-        elapsed_time = time.time() - start_time
-        if elapsed_time >= MAX_WAIT_TIME:
-            raise TimeoutError(f"Output file not found in S3 after {MAX_WAIT_TIME} seconds: {output_key}")
-        
-        try:
-            s3_client.head_object(Bucket=bucket, Key=output_key)
-            output_url = f's3://{bucket}/{output_key}'
-            processing_time = round(elapsed_time, 2)  # Round to 2 decimal places
-            print(f"Image Processing: Face restoration completed successfully. Processing Time: {processing_time} seconds. Output: {output_url}")
-            return output_url
-        except s3_client.exceptions.ClientError as e:
-            if e.response['Error']['Code'] != '404':
-                raise
-        time.sleep(CHECK_INTERVAL)
+    output_url = f"s3://{response['bucket']}/{response['output']}"
+    print(f"Image Processing: Face restoration completed successfully. Processing Time: {processing_time} seconds. Output: {output_url}")
+    return output_url
 
 def create_success_response(output_url: str) -> Dict[str, Any]:
     return {
@@ -74,6 +76,15 @@ def create_success_response(output_url: str) -> Dict[str, Any]:
         })
     }
 
+def create_accepted_response(output_location: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 202,
+        'body': json.dumps({
+            'message': 'Image Processing: Face restoration request accepted.',
+            'output_location': output_location
+        })
+    }
+
 def create_error_response(error_message: str) -> Dict[str, Any]:
     return {
         'statusCode': 500,
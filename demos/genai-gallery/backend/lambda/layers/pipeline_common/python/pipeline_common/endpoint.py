@@ -0,0 +1,160 @@
+"""Invocation of the SageMaker endpoint behind a pipeline stage.
+
+ENDPOINT_MODE=sync (default) calls invoke_endpoint, which returns once the predictor has
+uploaded its output, and hands back the predictor's JSON response.
+
+ENDPOINT_MODE=async stores the payload under ASYNC_INPUT_PATH, calls invoke_endpoint_async and
+returns at once. When the inference finishes, SageMaker publishes to the endpoint's SNS success
+topic, which triggers the next stage (see read_completion), or to its error topic, whose
+notifications mark the job failed (see completion_uuid).
+
+Setting ENDPOINT_URL replaces SageMaker with a LocalEndpoint, e.g. a predictor container
+started with `docker run -p 8080:8080 <image>`:
+
+    ENDPOINT_URL=http://localhost:8080/invocations
+
+In tests, assign a LocalEndpoint to the stage's module-level ``endpoint`` with a callable
+stand-in for the predictor, and the next stage's handler as ``notify``:
+
+    roop.endpoint = LocalEndpoint(fake_predictor, notify=gfpgan.lambda_handler)
+"""
+import json
+import os
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional, Union
+
+import boto3
+
+ENDPOINT_MODE = os.environ.get('ENDPOINT_MODE', 'sync')
+ASYNC_INPUT_PATH = os.environ.get('ASYNC_INPUT_PATH', 'async/input/')
+
+sagemaker_runtime = boto3.client('sagemaker-runtime')
+s3_client = boto3.client('s3')
+
+# Responses of LocalEndpoint async invocations, keyed by their local:// output location
+LOCAL_OUTPUTS: Dict[str, Dict[str, Any]] = {}
+
+
+class SageMakerEndpoint:
+    def __init__(self, endpoint_name: str):
+        self.endpoint_name = endpoint_name
+
+    def invoke(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = sagemaker_runtime.invoke_endpoint(
+            EndpointName=self.endpoint_name,
+            ContentType='application/json',
+            Body=json.dumps(payload)
+        )
+        return json.loads(response['Body'].read())
+
+    def invoke_async(self, payload: Dict[str, Any], inference_id: str) -> str:
+        input_key = f"{ASYNC_INPUT_PATH}{inference_id}.json"
+        s3_client.put_object(Bucket=payload['bucket'], Key=input_key, Body=json.dumps(payload), ContentType='application/json')
+
+        response = sagemaker_runtime.invoke_endpoint_async(
+            EndpointName=self.endpoint_name,
+            ContentType='application/json',
+            InputLocation=f"s3://{payload['bucket']}/{input_key}",
+            InferenceId=inference_id
+        )
+        return response['OutputLocation']
+
+
+class LocalEndpoint:
+    """Stand-in for a SageMaker endpoint and its SNS notification topics.
+
+    ``target`` is the URL of a predictor's /invocations route or a callable that takes the
+    payload and returns the response. Async invocations run inline and pass an SNS-shaped
+    notification event to ``notify``.
+    """
+
+    def __init__(self, target: Union[str, Callable[[Dict[str, Any]], Dict[str, Any]]],
+                 notify: Optional[Callable[[Dict[str, Any], Any], Any]] = None):
+        self.target = target
+        self.notify = notify
+
+    def invoke(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if callable(self.target):
+            return self.target(payload)
+
+        request = urllib.request.Request(self.target, data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def invoke_async(self, payload: Dict[str, Any], inference_id: str) -> str:
+        output_location = f"local://{inference_id}.out"
+        try:
+            LOCAL_OUTPUTS[output_location] = self.invoke(payload)
+            notification = completion_notification(inference_id, 'Completed', output_location=output_location)
+        except Exception as e:
+            notification = completion_notification(inference_id, 'Failed', failure_reason=str(e))
+
+        if self.notify is not None:
+            sns_record = {'EventSource': 'aws:sns', 'Sns': {'MessageId': str(uuid.uuid4()), 'Message': json.dumps(notification)}}
+            self.notify({'Records': [sns_record]}, None)
+        return output_location
+
+
+def get_endpoint() -> Union[SageMakerEndpoint, LocalEndpoint]:
+    if os.environ.get('ENDPOINT_URL'):
+        return LocalEndpoint(os.environ['ENDPOINT_URL'])
+    return SageMakerEndpoint(os.environ['SAGEMAKER_ENDPOINT_NAME'])
+
+
+def new_inference_id(uuid_value: str) -> str:
+    # Inference ids must be unique per invocation, retries of the same image included
+    return f"{uuid_value}-{uuid.uuid4().hex[:8]}"
+
+
+def completion_notification(inference_id: str, status: str, output_location: Optional[str] = None,
+                            failure_reason: Optional[str] = None) -> Dict[str, Any]:
+    # Same shape as the message SageMaker publishes for asynchronous inference results
+    notification = {
+        'eventSource': 'aws:sagemaker',
+        'eventName': 'InferenceResult',
+        'eventTime': datetime.now(timezone.utc).isoformat(),
+        'inferenceId': inference_id,
+        'invocationStatus': status
+    }
+    if output_location:
+        notification['responseParameters'] = {'contentType': 'application/json', 'outputLocation': output_location}
+    if failure_reason:
+        notification['failureReason'] = failure_reason
+    return notification
+
+
+def is_completion_notification(record: Dict[str, Any]) -> bool:
+    return 'Sns' in record
+
+
+def completion_uuid(record: Dict[str, Any]) -> Optional[str]:
+    """Returns the uuid of the job an SNS completion notification record is about."""
+    if not is_completion_notification(record):
+        return None
+    inference_id = json.loads(record['Sns']['Message']).get('inferenceId')
+    # Inference ids are the uuid plus a suffix (see new_inference_id)
+    return inference_id.rsplit('-', 1)[0] if inference_id else None
+
+
+def read_completion(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the predictor response referenced by an SNS completion notification record."""
+    notification = json.loads(record['Sns']['Message'])
+    if notification.get('invocationStatus') != 'Completed':
+        raise RuntimeError(f"Inference {notification.get('inferenceId')} failed: {notification.get('failureReason')}")
+
+    output_location = notification['responseParameters']['outputLocation']
+    if output_location in LOCAL_OUTPUTS:
+        return LOCAL_OUTPUTS.pop(output_location)
+
+    bucket, key = output_location[len('s3://'):].split('/', 1)
+    return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+
+def timed_invoke(endpoint: Union[SageMakerEndpoint, LocalEndpoint], payload: Dict[str, Any]):
+    start_time = time.time()
+    response = endpoint.invoke(payload)
+    return response, round(time.time() - start_time, 2)
@@ -0,0 +1,22 @@
+"""Image formats of the objects a pipeline stage writes.
+
+OUTPUT_FORMAT is the codec of a stage's output and INTERMEDIATE_FORMAT the codec of the swapped
+image the fused roop stage can keep. The stack sets a faster codec than PNG only for the masked
+and swapped face images, which nothing but the next stage reads; final results stay PNG.
+
+    png       PNG at the default compression level
+    png-fast  PNG at compression level 1
+    webp      lossless WebP
+    npy       the raw BGR array the predictors decode into, no encoding at all
+"""
+import os
+
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'png')
+INTERMEDIATE_FORMAT = os.environ.get('INTERMEDIATE_FORMAT', 'png')
+
+FILE_EXTENSIONS = {'png': '.png', 'png-fast': '.png', 'webp': '.webp', 'npy': '.npy'}
+
+
+def image_key(path: str, uuid: str, image_format: str = 'png') -> str:
+    # The predictors tell the codec apart by the extension
+    return f"{path}{uuid}{FILE_EXTENSIONS[image_format]}"
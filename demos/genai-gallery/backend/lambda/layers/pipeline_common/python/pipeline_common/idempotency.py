@@ -0,0 +1,101 @@
+"""Claims that keep duplicate event deliveries from running a stage twice.
+
+S3 and SNS deliver events at least once. Before a stage processes a record it claims the key
+stage + object + ETag (or the SNS message ID) with a conditional write to the table named by
+IDEMPOTENCY_TABLE_NAME. A record whose claim is completed was processed by another invocation
+and is skipped. A record another invocation is processing is delivered again later (see records),
+since that invocation may crash before it completes:
+
+    claim()     in_progress, fails if completed or in progress within its lease
+    complete()  completed, kept until the TTL removes it
+    release()   deleted, so a retry of a failed record can claim it again
+
+A claim left in progress by an invocation that timed out or crashed can be taken over once its
+lease ends. Without the table, or when it cannot be reached, every record is processed.
+"""
+import os
+import time
+from typing import Any, Dict, Optional
+
+import boto3
+
+IDEMPOTENCY_TABLE_NAME = os.environ.get('IDEMPOTENCY_TABLE_NAME')
+# Longer than the 300-second function timeout, so only abandoned claims are taken over
+LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', 330))
+# Duplicate deliveries arrive within minutes; the claims only need to outlive them
+CLAIM_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600))
+
+dynamodb_client = boto3.client('dynamodb') if IDEMPOTENCY_TABLE_NAME else None
+
+
+def claim_key(stage: str, record: Dict[str, Any]) -> Optional[str]:
+    if 's3' in record:
+        s3_object = record['s3']['object']
+        # A new upload to the same key has a new ETag and is processed again
+        version = s3_object.get('eTag') or s3_object.get('sequencer')
+        return f"{stage}#{record['s3']['bucket']['name']}/{s3_object['key']}#{version}"
+    if 'Sns' in record:
+        return f"{stage}#{record['Sns']['MessageId']}"
+    return None
+
+
+def claim(key: str) -> bool:
+    if dynamodb_client is None:
+        return True
+
+    now = int(time.time())
+    try:
+        dynamodb_client.put_item(
+            TableName=IDEMPOTENCY_TABLE_NAME,
+            Item={
+                'claim_key': {'S': key},
+                'status': {'S': 'in_progress'},
+                'lease_expires_at': {'N': str(now + LEASE_SECONDS)},
+                'expires_at': {'N': str(now + CLAIM_TTL_SECONDS)}
+            },
+            ConditionExpression='attribute_not_exists(claim_key) OR (#status = :in_progress AND lease_expires_at < :now)',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':in_progress': {'S': 'in_progress'}, ':now': {'N': str(now)}}
+        )
+        return True
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return False
+    except Exception as e:
+        print(f"Idempotency claim failed for {key}, processing anyway: {e}")
+        return True
+
+
+def claim_status(key: str) -> Optional[str]:
+    """Returns the status of the claim on key, or None if there is none or it cannot be read."""
+    if dynamodb_client is None:
+        return None
+    try:
+        item = dynamodb_client.get_item(TableName=IDEMPOTENCY_TABLE_NAME, Key={'claim_key': {'S': key}}, ConsistentRead=True).get('Item')
+    except Exception as e:
+        print(f"Idempotency status read failed for {key}: {e}")
+        return None
+    return item['status']['S'] if item else None
+
+
+def complete(key: str) -> None:
+    if dynamodb_client is None:
+        return
+    try:
+        dynamodb_client.update_item(
+            TableName=IDEMPOTENCY_TABLE_NAME,
+            Key={'claim_key': {'S': key}},
+            UpdateExpression='SET #status = :completed',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':completed': {'S': 'completed'}}
+        )
+    except Exception as e:
+        print(f"Idempotency completion failed for {key}: {e}")
+
+
+def release(key: str) -> None:
+    if dynamodb_client is None:
+        return
+    try:
+        dynamodb_client.delete_item(TableName=IDEMPOTENCY_TABLE_NAME, Key={'claim_key': {'S': key}})
+    except Exception as e:
+        print(f"Idempotency release failed for {key}: {e}")
@@ -0,0 +1,120 @@
+"""Per-job status records in the DynamoDB table named by JOB_TABLE_NAME.
+
+Each stage records the state it moves the job to and how long its work took, so the status
+API can tell a client what is happening instead of the client polling S3 blindly:
+
+    uploading -> detecting -> swapping -> restoring -> completed, or failed at any stage
+
+The next stage starts as soon as a stage writes its output, so a stage that records its timing
+afterwards passes state=None to leave the next stage's state in place.
+
+With the result cache, an upload identical to one in progress is recorded in that job's
+'duplicates' instead of being processed (see add_duplicate). The duplicates get the job's result
+once it lands, and fail with it if it fails.
+
+Jobs expire JOB_TTL_SECONDS after their last update until result_index puts them into the gallery
+by setting completed_at. From then on they do not expire: the gallery listing reads them through
+the indexes of this table, and their results stay in S3 as well.
+
+Status updates never fail a stage; without JOB_TABLE_NAME (e.g. local runs) they are skipped.
+They go through the low-level client, which unlike a boto3 resource can be shared by the threads
+that process the records of one event.
+"""
+import os
+import time
+from decimal import Decimal
+from typing import Any, Dict, Optional
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+JOB_TABLE_NAME = os.environ.get('JOB_TABLE_NAME')
+# Status records of unfinished jobs are only useful while a client waits for the result
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 7 * 24 * 3600))
+
+dynamodb_client = boto3.client('dynamodb') if JOB_TABLE_NAME else None
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def update_job(uuid: str, state: Optional[str], stage: Optional[str] = None, seconds: Optional[float] = None, **fields: Any) -> None:
+    if dynamodb_client is None:
+        return
+
+    now = int(time.time())
+    values = {'updated_at': now, **fields}
+    if state is not None:
+        values['state'] = state
+    if stage is not None and seconds is not None:
+        values[f"{stage}_seconds"] = Decimal(str(round(seconds, 2)))
+    return_values = 'ALL_NEW' if state == 'failed' else 'NONE'
+
+    try:
+        if 'completed_at' in fields:
+            response = set_job_values(uuid, values, return_values, 'REMOVE expires_at')
+        else:
+            try:
+                # Only jobs outside the gallery get a new expiry, also when an update comes in after the indexing
+                response = set_job_values(uuid, {**values, 'expires_at': now + JOB_TTL_SECONDS}, return_values,
+                                          condition='attribute_not_exists(completed_at)')
+            except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                response = set_job_values(uuid, values, return_values)
+    except Exception as e:
+        print(f"Job status update failed for {uuid}: {e}")
+        return
+
+    # The write and the read are one operation, so a duplicate added later sees the failed state instead
+    for duplicate in deserialize(response.get('Attributes', {})).get('duplicates', []):
+        update_job(duplicate, 'failed', error=f"The identical upload {uuid} failed: {fields.get('error', 'unknown error')}")
+
+
+def set_job_values(uuid: str, values: Dict[str, Any], return_values: str, remove: str = '', condition: Optional[str] = None) -> Dict[str, Any]:
+    request = {'ConditionExpression': condition} if condition else {}
+    return dynamodb_client.update_item(
+        TableName=JOB_TABLE_NAME,
+        Key={'uuid': {'S': uuid}},
+        UpdateExpression=' '.join(['SET ' + ', '.join(f"#{name} = :{name}" for name in values), remove]).strip(),
+        ExpressionAttributeNames={f"#{name}": name for name in values},
+        ExpressionAttributeValues={f":{name}": serializer.serialize(value) for name, value in values.items()},
+        ReturnValues=return_values,
+        **request
+    )
+
+
+def get_job(uuid: str) -> Dict[str, Any]:
+    if dynamodb_client is None:
+        return {}
+    try:
+        return deserialize(dynamodb_client.get_item(TableName=JOB_TABLE_NAME, Key={'uuid': {'S': uuid}}, ConsistentRead=True).get('Item', {}))
+    except Exception as e:
+        print(f"Job status read failed for {uuid}: {e}")
+        return {}
+
+
+def add_duplicate(uuid: str, duplicate_uuid: str) -> Optional[Dict[str, Any]]:
+    """Records duplicate_uuid as waiting for the result of job uuid and returns the job as it is after that.
+
+    None if the job does not exist (any more) or the table cannot be reached; the duplicate is then processed itself.
+    """
+    if dynamodb_client is None:
+        return None
+    try:
+        response = dynamodb_client.update_item(
+            TableName=JOB_TABLE_NAME,
+            Key={'uuid': {'S': uuid}},
+            UpdateExpression='ADD duplicates :duplicate',
+            ConditionExpression='attribute_exists(#uuid)',
+            ExpressionAttributeNames={'#uuid': 'uuid'},
+            ExpressionAttributeValues={':duplicate': {'SS': [duplicate_uuid]}},
+            ReturnValues='ALL_NEW'
+        )
+        return deserialize(response['Attributes'])
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return None
+    except Exception as e:
+        print(f"Recording {duplicate_uuid} as a duplicate of {uuid} failed: {e}")
+        return None
+
+
+def deserialize(item: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: deserializer.deserialize(value) for name, value in item.items()}
@@ -0,0 +1,88 @@
+"""Runs a stage on every record of an S3, SNS or SQS event.
+
+S3 can group several uploads into one event. Each record is processed on a bounded thread pool,
+since a stage mostly waits on S3, Rekognition or the endpoint, and the threads share the module's
+boto3 clients. A record that raises is reported in its own result and does not stop the others.
+Records another invocation already processed for the stage are skipped (see idempotency). A record
+another invocation holds in progress gets a 503 result, and is delivered again: the event raises
+ClaimInProgress so that Lambda retries it, and the records completed by then are skipped.
+
+With the stage queue, the S3 events arrive as SQS messages. handle_event then reports the messages
+with a failed record, in progress ones included, back to the event source mapping, so only those
+are received again, after the visibility timeout and so after the claim's lease.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from pipeline_common import idempotency
+
+# Records processed at the same time in one invocation
+RECORD_WORKERS = int(os.environ.get('RECORD_WORKERS', 4))
+# Result of a record whose claim another invocation holds
+IN_PROGRESS_STATUS_CODE = 503
+
+
+class ClaimInProgress(Exception):
+    pass
+
+
+def handle_event(event: Dict[str, Any], stage: str, process_record: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    records = event['Records']
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        return handle_queue_messages(records, stage, process_record)
+    return create_batch_response(process_records(records, stage, process_record))
+
+
+def handle_queue_messages(messages: List[Dict[str, Any]], stage: str, process_record: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    # Each message body is an S3 event; the s3:TestEvent sent when the notification is set up has no Records
+    message_records = [json.loads(message['body']).get('Records', []) for message in messages]
+    results = iter(process_records([record for records in message_records for record in records], stage, process_record))
+
+    failures = []
+    for message, records in zip(messages, message_records):
+        if any([next(results)['statusCode'] >= 500 for _ in records]):
+            failures.append({'itemIdentifier': message['messageId']})
+    # Failed messages return to the queue, and to its dead-letter queue after maxReceiveCount receives
+    return {'batchItemFailures': failures}
+
+
+def process_records(records: List[Dict[str, Any]], stage: str, process_record: Callable[[Dict[str, Any]], Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def run(record: Dict[str, Any]) -> Dict[str, Any]:
+        key = idempotency.claim_key(stage, record)
+        if key and not idempotency.claim(key):
+            if idempotency.claim_status(key) == 'completed':
+                print(f"Skipping {key}: already processed")
+                return {'statusCode': 200, 'body': json.dumps({'message': 'Skipped duplicate delivery.', 'claim': key})}
+            # The invocation holding the claim may have crashed; a later delivery takes it over after the lease
+            print(f"Retrying {key} later: in progress in another invocation")
+            return {'statusCode': IN_PROGRESS_STATUS_CODE, 'body': json.dumps({'error': 'Claimed by another invocation.', 'claim': key})}
+
+        try:
+            result = process_record(record)
+        except Exception as e:
+            print(f"Error processing record: {str(e)}")
+            result = {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+        if key and result['statusCode'] >= 500:
+            idempotency.release(key)
+        elif key:
+            idempotency.complete(key)
+        return result
+
+    if len(records) == 1:
+        return [run(records[0])]
+    with ThreadPoolExecutor(max_workers=min(RECORD_WORKERS, len(records))) as executor:
+        return list(executor.map(run, records))
+
+
+def create_batch_response(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    in_progress = [json.loads(result['body'])['claim'] for result in results if result['statusCode'] == IN_PROGRESS_STATUS_CODE]
+    if in_progress:
+        raise ClaimInProgress(f"Claimed by another invocation: {', '.join(in_progress)}")
+    # One result per record, in the order of the event
+    return {
+        'statusCode': max((result['statusCode'] for result in results), default=200),
+        'results': results
+    }
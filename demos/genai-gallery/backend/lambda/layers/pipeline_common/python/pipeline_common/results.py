@@ -0,0 +1,36 @@
+"""Final results under RESULT_PATH and copies of them between uploads.
+
+Next to each final result {uuid}.png the final stage writes its renditions, and it uploads them
+before the PNG. Once {uuid}.png exists, its renditions do too. A copy follows the same order:
+the renditions first, then the PNG, whose S3 event lets result_index complete the job it was
+copied to.
+"""
+import os
+
+import boto3
+from botocore.exceptions import ClientError
+
+RESULT_PATH = os.environ.get('RESULT_PATH')
+# Renditions of the final stage (result_variants in the predictors); AVIF only where the container's Pillow supports it
+RENDITION_SUFFIXES = ['.thumb.webp', '.thumb.avif', '.screen.webp', '.screen.avif']
+
+s3_client = boto3.client('s3')
+
+
+def result_key(uuid: str, suffix: str = '.png') -> str:
+    return f"{RESULT_PATH}{uuid}{suffix}"
+
+
+def copy_result(bucket: str, from_uuid: str, to_uuid: str) -> str:
+    for suffix in RENDITION_SUFFIXES:
+        try:
+            copy_object(bucket, result_key(from_uuid, suffix), result_key(to_uuid, suffix))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+    copy_object(bucket, result_key(from_uuid), result_key(to_uuid))
+    return result_key(to_uuid)
+
+
+def copy_object(bucket: str, source_key: str, key: str) -> None:
+    s3_client.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': bucket, 'Key': source_key})
@@ -0,0 +1,28 @@
+import os
+import time
+import urllib.parse
+from typing import Dict, Any
+
+from pipeline_common.job_status import get_job, update_job
+from pipeline_common.records import process_records, create_batch_response
+from pipeline_common.results import copy_result, result_key
+
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return create_batch_response(process_records(event['Records'], 'index', process_record))
+
+def process_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    # Every final result lands here, whichever stage or inference mode wrote it
+    object_key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+    uuid = os.path.splitext(os.path.basename(object_key))[0]
+
+    # completed_at puts the job into the gallery indexes of its event and batch, newest first, and ends its expiry
+    update_job(uuid, 'completed', result_key=object_key, thumb_key=result_key(uuid, '.thumb.webp'), completed_at=int(time.time()))
+    print(f"Result index: {uuid} completed with {object_key}")
+
+    # Identical uploads waiting for this result (see lambda/roop/result_cache.py); each copied PNG lands here again.
+    # The read follows the completed state, so a duplicate added after it copies the result itself.
+    for duplicate in get_job(uuid).get('duplicates', []):
+        copy_result(record['s3']['bucket']['name'], uuid, duplicate)
+        print(f"Result index: copied the result of {uuid} to its duplicate {duplicate}")
+    return {'statusCode': 200}
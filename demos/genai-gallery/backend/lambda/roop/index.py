@@ -2,53 +2,123 @@ import json
 import boto3
 import os
 import urllib.parse
-import time
 import random
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+from pipeline_common.endpoint import ENDPOINT_MODE, get_endpoint, new_inference_id, timed_invoke, is_completion_notification, read_completion, completion_uuid
+from pipeline_common.formats import OUTPUT_FORMAT, INTERMEDIATE_FORMAT, image_key
+from pipeline_common.job_status import update_job
+from pipeline_common.records import handle_event
+from pipeline_common.results import copy_result, result_key
+import result_cache
 
 # Initialize AWS clients
-sagemaker_runtime = boto3.client('sagemaker-runtime')
 s3_client = boto3.client('s3')
+endpoint = get_endpoint()
 
 # Constants
-MAX_WAIT_TIME = 30  # Maximum wait time in seconds
-CHECK_INTERVAL = 1  # Time between checks in seconds
 BASE_IMAGE_PREFIX = 'images/base/'
+# In the fused pipeline the roop endpoint also restores, so its output is the final result
+FINAL_STAGE = os.environ.get('PIPELINE_MODE') == 'fused'
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return handle_event(event, 'swap', process_record)
+
+def process_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    input_data = None
     try:
-        s3_event = event['Records'][0]['s3']
-        input_data = prepare_input_data(s3_event)
-        invoke_sagemaker_endpoint(input_data)
-        
-        output_url = wait_for_output_file(input_data['bucket'], input_data['output'])
-        
+        if is_completion_notification(record):
+            # Fused async mode subscribes this stage to the endpoint's error topic, so read_completion raises
+            read_completion(record)
+            raise RuntimeError(f"Unexpected notification of a completed swap: {record['Sns']['MessageId']}")
+
+        s3_event = record['s3']
+        face_hash = get_face_hash(s3_event)
+        input_data = prepare_input_data(s3_event, face_hash)
+        update_job(input_data['uuid'], 'swapping')
+
+        if face_hash:
+            owner_job = result_cache.claim(result_cache.cache_key(face_hash, input_data['target']), input_data['uuid'])
+            if owner_job:
+                return follow_cached_result(owner_job, input_data)
+
+        if ENDPOINT_MODE == 'async':
+            # The endpoint's success topic triggers the next stage once the swap is done
+            output_location = endpoint.invoke_async(input_data, new_inference_id(input_data['uuid']))
+            return create_accepted_response(output_location)
+
+        response, processing_time = timed_invoke(endpoint, input_data)
+        output_url = get_output_url(response, processing_time)
+        if FINAL_STAGE:
+            update_job(input_data['uuid'], 'completed', 'swap', processing_time, result_key=response['output'])
+        else:
+            update_job(input_data['uuid'], None, 'swap', processing_time)
+
         return create_success_response(output_url)
     except Exception as e:
         print(f"Error processing request: {str(e)}")
+        uuid = input_data['uuid'] if input_data else completion_uuid(record)
+        if uuid:
+            update_job(uuid, 'failed', error=str(e))
         return create_error_response(str(e))
 
-def prepare_input_data(s3_event: Dict[str, Any]) -> Dict[str, str]:
+def get_face_hash(s3_event: Dict[str, Any]) -> Optional[str]:
+    if not result_cache.enabled():
+        return None
+    return result_cache.content_hash(s3_event['bucket']['name'], urllib.parse.unquote_plus(s3_event['object']['key']))
+
+def follow_cached_result(owner_job: Dict[str, Any], input_data: Dict[str, str]) -> Dict[str, Any]:
+    # An identical upload produces the result, and result_index copies it here once it lands
+    owner = owner_job['uuid']
+    update_job(input_data['uuid'], None, cached_from=owner)
+    if owner_job.get('state') == 'completed':
+        # The result landed before this upload became its duplicate; the copied PNG completes the job
+        copy_result(input_data['bucket'], owner, input_data['uuid'])
+        message = 'Result copied from an identical earlier upload.'
+    else:
+        message = 'Result will be copied from an identical upload in progress.'
+    print(f"Result cache: {input_data['uuid']} is a duplicate of {owner}, skipping the GPU stages")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': f"Image Processing: {message}",
+            'output_url': f"s3://{input_data['bucket']}/{result_key(input_data['uuid'])}"
+        })
+    }
+
+def prepare_input_data(s3_event: Dict[str, Any], face_hash: Optional[str] = None) -> Dict[str, str]:
     bucket_name = s3_event['bucket']['name']
     encoded_object_key = s3_event['object']['key']
     source_object_key = urllib.parse.unquote_plus(encoded_object_key)
     source_filename = os.path.basename(source_object_key)
-    output_object_key = f"{os.environ['OUTPUT_PATH']}{source_filename}"
     uuid = os.path.splitext(source_filename)[0]
+    output_object_key = image_key(os.environ['OUTPUT_PATH'], uuid, OUTPUT_FORMAT)
 
-    # Get a random target image
-    target_key = get_random_image(bucket_name, BASE_IMAGE_PREFIX)
+    # Get a random target image; the same face crop always gets the same one, so its result can be reused
+    target_key = get_random_image(bucket_name, BASE_IMAGE_PREFIX, face_hash)
 
     # Prepare and return the input data dictionary
-    return {
+    input_data = {
         'uuid': uuid,
         'bucket': bucket_name,
         'source': source_object_key,
         'target': target_key,
-        'output': output_object_key
+        'output': output_object_key,
+        'output_format': OUTPUT_FORMAT
     }
 
-def get_random_image(bucket: str, prefix: str) -> str:
+    # Progressive results: a small preview of the swap next to where the final result will be
+    if os.environ.get('PREVIEW_PATH'):
+        input_data['preview'] = f"{os.environ['PREVIEW_PATH']}{uuid}.preview.webp"
+
+    # Fused pipeline mode: also keep the swapped image before GFPGAN restoration
+    if os.environ.get('INTERMEDIATE_PATH'):
+        input_data['intermediate'] = image_key(os.environ['INTERMEDIATE_PATH'], uuid, INTERMEDIATE_FORMAT)
+        input_data['intermediate_format'] = INTERMEDIATE_FORMAT
+
+    return input_data
+
+def get_random_image(bucket: str, prefix: str, seed: Optional[str] = None) -> str:
     response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
     if 'Contents' not in response:
         raise Exception(f"No images found in {prefix}")
@@ -57,33 +127,18 @@ def get_random_image(bucket: str, prefix: str) -> str:
     if not images:
         raise Exception(f"No valid images found in {prefix}")
     
+    if seed:
+        return sorted(images)[int(seed, 16) % len(images)]
     return random.choice(images)
 
-def invoke_sagemaker_endpoint(input_data: Dict[str, str]) -> None:
-    sagemaker_runtime.invoke_endpoint(
-        EndpointName=os.environ['SAGEMAKER_ENDPOINT_NAME'],
-        ContentType='application/json',
-        Body=json.dumps(input_data)
-    )
+def get_output_url(response: Dict[str, Any], processing_time: float) -> str:
+    # invoke_endpoint returns after the predictor has uploaded the output
+    if response.get('status') != 'completed':
+        raise RuntimeError(f"Endpoint did not complete the request: {response}")
 
-def wait_for_output_file(bucket: str, output_key: str) -> str:
-    start_time = time.time()
-    
-    while True:
-        elapsed_time = time.time() - start_time
-        if elapsed_time >= MAX_WAIT_TIME:
-            raise TimeoutError(f"Output file not found in S3 after {MAX_WAIT_TIME} seconds: {output_key}")
-        
-        try:
-            s3_client.head_object(Bucket=bucket, Key=output_key)
-            s3_url = f's3://{bucket}/{output_key}'
-            processing_time = round(elapsed_time, 2)  # Round to 2 decimal places
-            print(f"Image Processing: Image swapped and upload completed successfully. Processing Time: {processing_time} seconds. Output: {s3_url}")
-            return s3_url
-        except s3_client.exceptions.ClientError as e:
-            if e.response['Error']['Code'] != '404':
-                raise
-        time.sleep(CHECK_INTERVAL)
+    s3_url = f"s3://{response['bucket']}/{response['output']}"
+    print(f"Image Processing: Image swapped and upload completed successfully. Processing Time: {processing_time} seconds. Output: {s3_url}")
+    return s3_url
 
 def create_success_response(output_url: str) -> Dict[str, Any]:
     return {
@@ -94,6 +149,15 @@ def create_success_response(output_url: str) -> Dict[str, Any]:
         })
     }
 
+def create_accepted_response(output_location: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 202,
+        'body': json.dumps({
+            'message': 'Image Processing: Image swap request accepted.',
+            'output_location': output_location
+        })
+    }
+
 def create_error_response(error_message: str) -> Dict[str, Any]:
     return {
         'statusCode': 500,
@@ -0,0 +1,115 @@
+"""Content-addressed cache of final results, keyed by face crop, target and model settings.
+
+face_detection stores the SHA-256 of each face crop in the 'content-hash' metadata of the
+object. The roop stage combines it with the target and the settings that change the result into
+a cache key, and claims the key for its upload with a conditional write, so the first upload of a
+photo produces the result. Every later upload of it (a retry, a double tap, or two records of one
+event) loses the claim and is recorded as a duplicate of that upload instead of running the GPU
+stages. result_index copies the result to the duplicates once it lands (pipeline_common.results),
+and a duplicate whose upload already completed copies it at once.
+
+The claim records when it was made. An upload that has neither completed nor failed
+OWNER_TIMEOUT_SECONDS later is taken to be stuck, e.g. after its invocation crashed, and the next
+identical upload takes the claim over together with the duplicates waiting for it.
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import boto3
+
+from pipeline_common.job_status import add_duplicate, get_job
+
+RESULT_CACHE_TABLE_NAME = os.environ.get('RESULT_CACHE_TABLE_NAME')
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+# Takeovers of keys whose upload failed or expired are rare; after this many tries the upload is processed anyway
+CLAIM_ATTEMPTS = 3
+# Longer than any upload takes through both GPU stages, with the retries of failed invocations and
+# the queue of an asynchronous endpoint
+OWNER_TIMEOUT_SECONDS = int(os.environ.get('RESULT_CACHE_OWNER_TIMEOUT_SECONDS', 2 * 3600))
+# Everything besides the crop and the target that changes the result
+MODEL_SETTINGS = {
+    'endpoint': os.environ.get('SAGEMAKER_ENDPOINT_NAME'),
+    'pipeline_mode': os.environ.get('PIPELINE_MODE', 'chain'),
+    'version': os.environ.get('RESULT_CACHE_VERSION', '1')
+}
+
+s3_client = boto3.client('s3')
+dynamodb_client = boto3.client('dynamodb') if RESULT_CACHE_TABLE_NAME else None
+
+
+def enabled() -> bool:
+    return dynamodb_client is not None
+
+
+def content_hash(bucket: str, object_key: str) -> Optional[str]:
+    response = s3_client.head_object(Bucket=bucket, Key=object_key)
+    return response['Metadata'].get('content-hash')
+
+
+def cache_key(face_hash: str, target_key: str) -> str:
+    settings = json.dumps({'target': target_key, **MODEL_SETTINGS}, sort_keys=True)
+    return hashlib.sha256(f"{face_hash}:{settings}".encode()).hexdigest()
+
+
+def claim(key: str, uuid: str) -> Optional[Dict[str, Any]]:
+    """Makes uuid the upload that produces the result for key, unless another upload already does.
+
+    Returns the job of that other upload, after recording uuid as its duplicate, or None when uuid is
+    to be processed. An upload whose job failed, no longer exists or is stuck gives way to the next one.
+    """
+    owner = None
+    for _ in range(CLAIM_ATTEMPTS):
+        if put_owner(key, uuid, owner):
+            return None
+        owner, claimed_at = lookup(key)
+        if owner == uuid:
+            # A retry of the record that made the claim
+            return None
+        if owner is None:
+            continue
+        if time.time() - claimed_at > OWNER_TIMEOUT_SECONDS:
+            stuck_job = get_job(owner)
+            if stuck_job.get('state') != 'completed':
+                if put_owner(key, uuid, owner):
+                    print(f"Result cache: {owner} made no progress on {key}, {uuid} takes over")
+                    for duplicate in stuck_job.get('duplicates', []):
+                        add_duplicate(uuid, duplicate)
+                    return None
+                # Another upload took over first
+                continue
+        owner_job = add_duplicate(owner, uuid)
+        if owner_job is not None and owner_job.get('state') != 'failed':
+            return owner_job
+    print(f"Result cache: no claim on {key} after {CLAIM_ATTEMPTS} attempts, processing {uuid}")
+    return None
+
+
+def put_owner(key: str, uuid: str, expected_owner: Optional[str]) -> bool:
+    # The first writer wins; a takeover only replaces the owner it found
+    condition = {'ConditionExpression': 'attribute_not_exists(cache_key)'} if expected_owner is None else {
+        'ConditionExpression': '#uuid = :expected',
+        'ExpressionAttributeNames': {'#uuid': 'uuid'},
+        'ExpressionAttributeValues': {':expected': {'S': expected_owner}}
+    }
+    now = int(time.time())
+    try:
+        dynamodb_client.put_item(TableName=RESULT_CACHE_TABLE_NAME, Item={
+            'cache_key': {'S': key},
+            'uuid': {'S': uuid},
+            'claimed_at': {'N': str(now)},
+            'expires_at': {'N': str(now + CACHE_TTL_SECONDS)}
+        }, **condition)
+        return True
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def lookup(key: str) -> Tuple[Optional[str], int]:
+    # The owner of key and when it claimed it; claims made before claimed_at was stored count as old
+    item = dynamodb_client.get_item(TableName=RESULT_CACHE_TABLE_NAME, Key={'cache_key': {'S': key}}, ConsistentRead=True).get('Item')
+    if not item:
+        return None, 0
+    return item['uuid']['S'], int(item.get('claimed_at', {'N': '0'})['N'])
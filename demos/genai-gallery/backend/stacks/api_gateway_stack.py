@@ -4,19 +4,24 @@ from aws_cdk import (
     aws_apigateway as apigw,
     aws_lambda as lambda_,
     aws_ssm as ssm,
-    aws_iam as iam
+    aws_iam as iam,
+    aws_dynamodb as dynamodb,
+    aws_cloudfront as cloudfront,
+    aws_secretsmanager as secretsmanager,
+    Duration
 )
 from constructs import Construct
 import os
 
 class ApiGatewayStack(Stack):
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, job_table: dynamodb.ITable, result_distribution: cloudfront.IDistribution = None, cdn_public_key: cloudfront.IPublicKey = None, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         s3_base_bucket_name = self.node.try_get_context("s3_base_bucket_name")
         self.s3_bucket_name = f"{s3_base_bucket_name}-{self.account}"
         self.s3_face_images_path = self.node.try_get_context("s3_face_images_path")
         self.s3_result_images_path = self.node.try_get_context("s3_result_images_path")
+        self.job_table = job_table
 
         self.api = self.create_api_gateway()
         self.upload_lambda = self.create_lambda_function("UploadImageFunction", "upload", self.s3_face_images_path)
@@ -26,13 +31,26 @@ class ApiGatewayStack(Stack):
                 resources=[f"arn:aws:s3:::{self.s3_bucket_name}/*"],
             )
         )
-        self.get_image_lambda = self.create_lambda_function("GetImageFunction", "get_image", self.s3_result_images_path)
+        self.job_table.grant_write_data(self.upload_lambda)
+        # The status API long-polls the job for up to 20 seconds
+        self.get_image_lambda = self.create_lambda_function("GetImageFunction", "get_image", self.s3_result_images_path, Duration.seconds(25))
+        self.job_table.grant_read_data(self.get_image_lambda)
         self.get_image_lambda.add_to_role_policy(
             iam.PolicyStatement(
                 actions=["s3:GetObject"],
                 resources=[f"arn:aws:s3:::{self.s3_bucket_name}/*"],
             )
         )
+        # get_image lists the renditions of a result to pick the best available one
+        self.get_image_lambda.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["s3:ListBucket"],
+                resources=[f"arn:aws:s3:::{self.s3_bucket_name}"],
+                conditions={"StringLike": {"s3:prefix": [f"{self.s3_result_images_path}*"]}}
+            )
+        )
+        if result_distribution:
+            self.add_result_cdn(result_distribution, cdn_public_key)
 
         self.create_api_resources()
         self.store_api_endpoints_in_ssm()
@@ -43,54 +61,66 @@ class ApiGatewayStack(Stack):
             rest_api_name="GenAI Gallery Image API",
             description="This service processes images.")
 
-    def create_lambda_function(self, id, handler, object_path):
+    def create_lambda_function(self, id, handler, object_path, timeout=Duration.seconds(3)):
         return lambda_.Function(self, id,
             runtime=lambda_.Runtime.PYTHON_3_9,
             handler=f"index.handler",
             code=lambda_.Code.from_asset(os.path.join("lambda", "apis", handler)),
+            timeout=timeout,
             environment={
                 "BUCKET_NAME": self.s3_bucket_name,
-                "OBJECT_PATH": object_path
+                "OBJECT_PATH": object_path,
+                "JOB_TABLE_NAME": self.job_table.table_name
             })
 
+    def add_result_cdn(self, result_distribution, cdn_public_key):
+        # get_image hands out CloudFront URLs signed with the private key of cdn_public_key
+        secret_name = self.node.try_get_context("cdn_private_key_secret_name")
+        cryptography_layer_arn = self.node.try_get_context("cryptography_layer_arn")
+        if not secret_name or not cryptography_layer_arn:
+            raise ValueError("result_cdn requires cdn_private_key_secret_name and cryptography_layer_arn in cdk.context.json")
+
+        private_key_secret = secretsmanager.Secret.from_secret_name_v2(self, "ResultCdnPrivateKey", secret_name)
+        private_key_secret.grant_read(self.get_image_lambda)
+        self.get_image_lambda.add_layers(lambda_.LayerVersion.from_layer_version_arn(
+            self, "CryptographyLayer",
+            layer_version_arn=cryptography_layer_arn
+        ))
+        self.get_image_lambda.add_environment("CDN_DOMAIN_NAME", result_distribution.distribution_domain_name)
+        self.get_image_lambda.add_environment("CDN_KEY_PAIR_ID", cdn_public_key.public_key_id)
+        self.get_image_lambda.add_environment("CDN_PRIVATE_KEY_SECRET", secret_name)
+
     def create_api_resources(self):
         images_resource = self.api.root.add_resource("apis").add_resource("images")
         
+        self.create_list_images_resource(images_resource)
         self.create_upload_resource(images_resource)
         self.create_get_image_resource(images_resource)
 
+    def create_list_images_resource(self, images_resource):
+        # GET /apis/images lists completed results newest first, served by the get_image Lambda
+        self.add_cors_preflight(images_resource)
+        images_resource.add_method("GET", apigw.LambdaIntegration(self.get_image_lambda))
+
     def create_upload_resource(self, parent_resource):
         upload_resource = parent_resource.add_resource("upload")
         upload_integration = apigw.LambdaIntegration(self.upload_lambda)
-        upload_resource.add_method(
-            "OPTIONS",
-            apigw.MockIntegration(
-                integration_responses=[apigw.IntegrationResponse(
-                    status_code="200",
-                    response_parameters={
-                        "method.response.header.Access-Control-Allow-Headers": "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'",
-                        "method.response.header.Access-Control-Allow-Origin": "'*'",
-                        "method.response.header.Access-Control-Allow-Methods": "'OPTIONS,GET'"
-                    }
-                )],
-                passthrough_behavior=apigw.PassthroughBehavior.NEVER,
-                request_templates={"application/json": '{"statusCode": 200}'}
-            ),
-            method_responses=[apigw.MethodResponse(
-                status_code="200",
-                response_parameters={
-                    "method.response.header.Access-Control-Allow-Headers": True,
-                    "method.response.header.Access-Control-Allow-Methods": True,
-                    "method.response.header.Access-Control-Allow-Origin": True,
-                }
-            )]
-        )
+        self.add_cors_preflight(upload_resource)
         upload_resource.add_method("GET", upload_integration)
 
+        # GET /apis/images/upload/batch?count=N returns N presigned POST targets that share a batch ID
+        batch_resource = upload_resource.add_resource("batch")
+        self.add_cors_preflight(batch_resource)
+        batch_resource.add_method("GET", upload_integration)
+
     def create_get_image_resource(self, parent_resource):
         image_resource = parent_resource.add_resource("{uuid}")
         get_image_integration = apigw.LambdaIntegration(self.get_image_lambda)
-        image_resource.add_method(
+        self.add_cors_preflight(image_resource)
+        image_resource.add_method("GET", get_image_integration)
+
+    def add_cors_preflight(self, resource):
+        resource.add_method(
             "OPTIONS",
             apigw.MockIntegration(
                 integration_responses=[apigw.IntegrationResponse(
@@ -113,10 +143,10 @@ class ApiGatewayStack(Stack):
                 }
             )]
         )
-        image_resource.add_method("GET", get_image_integration)
 
     def store_api_endpoints_in_ssm(self):
         upload_endpoint = f"{self.api.url}apis/images/upload"
+        upload_batch_endpoint = f"{self.api.url}apis/images/upload/batch"
         get_image_endpoint = f"{self.api.url}apis/images/"
 
         ssm.StringParameter(self, "UploadApiEndpointParameter",
@@ -125,6 +155,12 @@ class ApiGatewayStack(Stack):
             description="Upload Image API Endpoint URL"
         )
 
+        ssm.StringParameter(self, "UploadBatchApiEndpointParameter",
+            parameter_name="/genai-gallery/upload-batch-api-endpoint",
+            string_value=upload_batch_endpoint,
+            description="Batch Upload API Endpoint URL"
+        )
+
         ssm.StringParameter(self, "GetImageApiEndpointParameter",
             parameter_name="/genai-gallery/get-image-api-endpoint",
             string_value=get_image_endpoint,
@@ -1,9 +1,15 @@
 from aws_cdk import (
     Stack,
     aws_s3 as s3,
+    aws_s3_notifications as s3n,
+    aws_sqs as sqs,
     aws_lambda as lambda_,
     aws_lambda_event_sources as lambda_events,
     aws_iam as iam,
+    aws_sns as sns,
+    aws_dynamodb as dynamodb,
+    aws_cloudfront as cloudfront,
+    aws_cloudfront_origins as origins,
     Duration,
     RemovalPolicy,
     CfnOutput
@@ -12,7 +18,8 @@ from constructs import Construct
 from aws_cdk.aws_s3_deployment import BucketDeployment, Source
 
 class ImageProcessingLambdaStack(Stack):
-    def __init__(self, scope: Construct, construct_id: str, roop_endpoint_name: str, gfpgan_endpoint_name: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, roop_endpoint_name: str, gfpgan_endpoint_name: str, roop_success_topic: sns.ITopic = None,
+                 roop_error_topic: sns.ITopic = None, gfpgan_error_topic: sns.ITopic = None, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         s3_base_bucket_name = self.node.try_get_context("s3_base_bucket_name")
@@ -21,15 +28,43 @@ class ImageProcessingLambdaStack(Stack):
         self.s3_masked_face_images_path = self.node.try_get_context("s3_masked_face_images_path")
         self.s3_swapped_face_images_path = self.node.try_get_context("s3_swapped_face_images_path")
         self.s3_result_images_path = self.node.try_get_context("s3_result_images_path")
+        # 'chain': face detection -> roop endpoint -> S3 -> GFPGAN endpoint, 'fused': roop endpoint swaps and restores
+        self.pipeline_mode = self.node.try_get_context("pipeline_mode") or "chain"
+        # 'async' hands the roop result to the GFPGAN Lambda through the endpoint's SNS success topic
+        self.inference_mode = self.node.try_get_context("inference_mode") or "sync"
+        self.roop_success_topic = roop_success_topic
+        # Failed asynchronous inferences, which mark their jobs failed
+        self.error_topics = [topic for topic in (roop_error_topic, gfpgan_error_topic) if topic]
+        # Codec of the masked and swapped face images, which only the next stage reads; final results stay PNG
+        self.intermediate_format = self.node.try_get_context("intermediate_format") or "png"
+        # Buffer the S3 events of the GPU stages in SQS and invoke them only as fast as the endpoints serve
+        self.stage_queue = self.node.try_get_context("stage_queue") or False
+        self.endpoint_instance_count = self.node.try_get_context("endpoint_instance_count") or 1
 
         self.lambda_role = self.create_lambda_role()
         self.bucket = self.create_s3_bucket()
+        self.job_table = self.create_job_table()
+        self.idempotency_table = self.create_idempotency_table()
+        self.pipeline_common_layer = self.create_pipeline_common_layer()
 
-        self.roop_lambda = self.create_lambda_function("RoopLambdaFunction", "lambda/roop", roop_endpoint_name, self.s3_swapped_face_images_path)
-        self.gfpgan_lambda = self.create_lambda_function("GfpganLambdaFunction", "lambda/gfpgan", gfpgan_endpoint_name, self.s3_result_images_path)
+        if self.pipeline_mode == "fused":
+            # The swapped image is only kept when save_intermediate_images is set; nothing listens on that prefix
+            intermediate_environment = {"INTERMEDIATE_PATH": self.s3_swapped_face_images_path, "INTERMEDIATE_FORMAT": self.intermediate_format} if self.node.try_get_context("save_intermediate_images") else {}
+            self.roop_lambda = self.create_lambda_function("RoopLambdaFunction", "lambda/roop", roop_endpoint_name, self.s3_result_images_path, {"PIPELINE_MODE": "fused", **intermediate_environment})
+            self.gfpgan_lambda = None
+        else:
+            # Optional small preview of the swap, published in the results prefix while GFPGAN restores
+            preview_environment = {"PREVIEW_PATH": self.s3_result_images_path} if self.node.try_get_context("preview_results") else {}
+            self.roop_lambda = self.create_lambda_function("RoopLambdaFunction", "lambda/roop", roop_endpoint_name, self.s3_swapped_face_images_path, {"OUTPUT_FORMAT": self.intermediate_format, **preview_environment})
+            self.gfpgan_lambda = self.create_lambda_function("GfpganLambdaFunction", "lambda/gfpgan", gfpgan_endpoint_name, self.s3_result_images_path)
         self.face_detection_lambda = self.create_face_detection_lambda()
+        # Optional content-addressed cache that reuses the result of an identical earlier upload
+        self.result_cache_table = self.create_result_cache() if self.node.try_get_context("result_cache") else None
+        # Optional CloudFront distribution serving the results through signed URLs
+        self.result_distribution, self.cdn_public_key = self.create_result_distribution() if self.node.try_get_context("result_cdn") else (None, None)
 
         self.add_s3_event_sources()
+        self.result_index_lambda = self.create_result_index_lambda()
         self.create_outputs()
 
         self.add_s3_cors_rule()
@@ -45,8 +80,20 @@ class ImageProcessingLambdaStack(Stack):
             ]
         )
 
-    def create_lambda_function(self, id, code_path, endpoint_name, output_path):
-        return lambda_.Function(self, id,
+    def create_pipeline_common_layer(self):
+        return lambda_.LayerVersion(self, "PipelineCommonLayer",
+            code=lambda_.Code.from_asset("lambda/layers/pipeline_common"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_8, lambda_.Runtime.PYTHON_3_9],
+            description="Helpers shared by the image processing Lambda functions"
+        )
+
+    def create_lambda_function(self, id, code_path, endpoint_name, output_path, environment=None):
+        if self.inference_mode == "async":
+            # Asynchronous inference reads its payload from S3, one input prefix per stage
+            stage = code_path.rsplit("/", 1)[-1]
+            environment = {"ENDPOINT_MODE": "async", "ASYNC_INPUT_PATH": f"async/input/{stage}/", **(environment or {})}
+
+        lambda_function = lambda_.Function(self, id,
             runtime=lambda_.Runtime.PYTHON_3_9,
             handler="index.lambda_handler",
             code=lambda_.Code.from_asset(code_path),
@@ -54,10 +101,17 @@ class ImageProcessingLambdaStack(Stack):
             memory_size=1024,
             environment={
                 "SAGEMAKER_ENDPOINT_NAME": endpoint_name,
-                "OUTPUT_PATH": output_path
+                "OUTPUT_PATH": output_path,
+                "JOB_TABLE_NAME": self.job_table.table_name,
+                "IDEMPOTENCY_TABLE_NAME": self.idempotency_table.table_name,
+                **(environment or {})
             },
+            layers=[self.pipeline_common_layer],
             role=self.lambda_role
         )
+        self.job_table.grant_read_write_data(lambda_function)
+        self.idempotency_table.grant_read_write_data(lambda_function)
+        return lambda_function
 
     def create_face_detection_lambda(self):
         current_region = self.region
@@ -74,6 +128,19 @@ class ImageProcessingLambdaStack(Stack):
             layer_version_arn=numpy_layer_arn
         )
 
+        # 'rekognition' calls Amazon Rekognition, 'opencv' detects faces in the Lambda with the OpenCV layer
+        face_detector = self.node.try_get_context("face_detector") or "rekognition"
+        max_face_edge = self.node.try_get_context("max_face_edge")
+        layers = [pillow_layer, numpy_layer, self.pipeline_common_layer]
+        if face_detector == "opencv":
+            opencv_layer_arn = self.node.try_get_context("opencv_layer_arn")
+            if not opencv_layer_arn:
+                raise ValueError("face_detector 'opencv' requires opencv_layer_arn in cdk.context.json")
+            layers.append(lambda_.LayerVersion.from_layer_version_arn(
+                self, "OpenCvLayer",
+                layer_version_arn=opencv_layer_arn
+            ))
+
         face_detection_lambda = lambda_.Function(self, "FaceDetectionLambda",
             runtime=lambda_.Runtime.PYTHON_3_8,
             handler="index.lambda_handler",
@@ -81,16 +148,27 @@ class ImageProcessingLambdaStack(Stack):
             timeout=Duration.seconds(300),
             environment={
                 "REGION": current_region,
-                "OUTPUT_PATH": self.s3_masked_face_images_path
+                "OUTPUT_PATH": self.s3_masked_face_images_path,
+                "OUTPUT_FORMAT": self.intermediate_format,
+                "JOB_TABLE_NAME": self.job_table.table_name,
+                "IDEMPOTENCY_TABLE_NAME": self.idempotency_table.table_name,
+                "FACE_DETECTOR": face_detector,
+                # Longest edge of the face crop handed to roop, 0 keeps the full resolution
+                "MAX_FACE_EDGE": str(512 if max_face_edge is None else max_face_edge),
+                # Uploads decoded at the same time when S3 groups several into one event; the function has 128 MB
+                "RECORD_WORKERS": "2"
             },
-            layers=[pillow_layer, numpy_layer]
+            layers=layers
         )
 
         self.bucket.grant_read_write(face_detection_lambda)
-        face_detection_lambda.add_to_role_policy(iam.PolicyStatement(
-            actions=["rekognition:DetectFaces"],
-            resources=["*"]
-        ))
+        self.job_table.grant_read_write_data(face_detection_lambda)
+        self.idempotency_table.grant_read_write_data(face_detection_lambda)
+        if face_detector == "rekognition":
+            face_detection_lambda.add_to_role_policy(iam.PolicyStatement(
+                actions=["rekognition:DetectFaces"],
+                resources=["*"]
+            ))
 
         return face_detection_lambda
 
@@ -101,10 +179,154 @@ class ImageProcessingLambdaStack(Stack):
             auto_delete_objects=True
         )
     
+    def create_job_table(self):
+        # One status record per uploaded image, written by every stage and read by the status API
+        job_table = dynamodb.Table(self, "JobStatusTable",
+            partition_key=dynamodb.Attribute(name="uuid", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        # Gallery listing, newest first; only jobs with completed_at, written by the result index Lambda, are in them
+        for index_name, partition_key in [("event-index", "event_id"), ("batch-index", "batch_id")]:
+            job_table.add_global_secondary_index(
+                index_name=index_name,
+                partition_key=dynamodb.Attribute(name=partition_key, type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(name="completed_at", type=dynamodb.AttributeType.NUMBER),
+                projection_type=dynamodb.ProjectionType.INCLUDE,
+                non_key_attributes=["result_key", "thumb_key"]
+            )
+        return job_table
+
+    def create_result_index_lambda(self):
+        result_index_lambda = lambda_.Function(self, "ResultIndexLambda",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            handler="index.lambda_handler",
+            code=lambda_.Code.from_asset("lambda/result_index"),
+            timeout=Duration.seconds(30),
+            environment={
+                "RESULT_PATH": self.s3_result_images_path,
+                "JOB_TABLE_NAME": self.job_table.table_name
+            },
+            layers=[self.pipeline_common_layer]
+        )
+        self.job_table.grant_read_write_data(result_index_lambda)
+        if self.result_cache_table:
+            # Copies each result to the identical uploads that wait for it
+            self.bucket.grant_read_write(result_index_lambda, f"{self.s3_result_images_path}*")
+        # Only the final {uuid}.png, not its renditions
+        result_index_lambda.add_event_source(lambda_events.S3EventSource(self.bucket,
+            events=[s3.EventType.OBJECT_CREATED],
+            filters=[s3.NotificationKeyFilter(prefix=self.s3_result_images_path, suffix=".png")]
+        ))
+        return result_index_lambda
+
+    def create_result_distribution(self):
+        encoded_key = self.node.try_get_context("cdn_public_key")
+        if not encoded_key:
+            raise ValueError("result_cdn requires cdn_public_key in cdk.context.json")
+        public_key = cloudfront.PublicKey(self, "ResultCdnPublicKey", encoded_key=encoded_key)
+        key_group = cloudfront.KeyGroup(self, "ResultCdnKeyGroup", items=[public_key])
+
+        # Result keys are written once per uuid and never overwritten, so edges and browsers can keep them for a year
+        result_cache_policy = cloudfront.CachePolicy(self, "ResultCachePolicy",
+            default_ttl=Duration.days(365),
+            min_ttl=Duration.days(1),
+            max_ttl=Duration.days(365),
+            query_string_behavior=cloudfront.CacheQueryStringBehavior.none(),
+            header_behavior=cloudfront.CacheHeaderBehavior.none(),
+            cookie_behavior=cloudfront.CacheCookieBehavior.none(),
+            enable_accept_encoding_gzip=False,
+            enable_accept_encoding_brotli=False
+        )
+        result_headers_policy = cloudfront.ResponseHeadersPolicy(self, "ResultResponseHeadersPolicy",
+            custom_headers_behavior=cloudfront.ResponseCustomHeadersBehavior(custom_headers=[
+                cloudfront.ResponseCustomHeader(header="Cache-Control", value="public, max-age=31536000, immutable", override=True)
+            ])
+        )
+
+        origin = origins.S3Origin(self.bucket)
+        distribution = cloudfront.Distribution(self, "ResultDistribution",
+            comment="GenAI Gallery results",
+            # Everything outside the results prefix stays private: signed and never cached
+            default_behavior=cloudfront.BehaviorOptions(
+                origin=origin,
+                trusted_key_groups=[key_group],
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.HTTPS_ONLY,
+                cache_policy=cloudfront.CachePolicy.CACHING_DISABLED
+            ),
+            additional_behaviors={
+                f"{self.s3_result_images_path}*": cloudfront.BehaviorOptions(
+                    origin=origin,
+                    trusted_key_groups=[key_group],
+                    viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.HTTPS_ONLY,
+                    cache_policy=result_cache_policy,
+                    response_headers_policy=result_headers_policy
+                )
+            }
+        )
+        return distribution, public_key
+
+    def create_result_cache(self):
+        result_cache_table = dynamodb.Table(self, "ResultCacheTable",
+            partition_key=dynamodb.Attribute(name="cache_key", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        result_cache_table.grant_read_write_data(self.roop_lambda)
+        self.roop_lambda.add_environment("RESULT_CACHE_TABLE_NAME", result_cache_table.table_name)
+        self.roop_lambda.add_environment("RESULT_PATH", self.s3_result_images_path)
+        # Part of the cache key; change it after updating the models to stop reusing older results
+        self.roop_lambda.add_environment("RESULT_CACHE_VERSION", str(self.node.try_get_context("result_cache_version") or 1))
+        return result_cache_table
+
+    def create_idempotency_table(self):
+        # Claims of stage + object + ETag, so duplicate event deliveries do not run a stage twice
+        return dynamodb.Table(self, "StageClaimTable",
+            partition_key=dynamodb.Attribute(name="claim_key", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
     def add_s3_event_sources(self):
         self.add_s3_event_source(self.face_detection_lambda, self.s3_face_images_path)
-        self.add_s3_event_source(self.roop_lambda, self.s3_masked_face_images_path)
-        self.add_s3_event_source(self.gfpgan_lambda, self.s3_swapped_face_images_path)
+        self.add_stage_event_source("Roop", self.roop_lambda, self.s3_masked_face_images_path)
+        if self.gfpgan_lambda and self.inference_mode == "async":
+            # The asynchronous endpoint queues requests itself
+            self.gfpgan_lambda.add_event_source(lambda_events.SnsEventSource(self.roop_success_topic))
+        elif self.gfpgan_lambda:
+            self.add_stage_event_source("Gfpgan", self.gfpgan_lambda, self.s3_swapped_face_images_path)
+        if self.inference_mode == "async":
+            error_lambda = self.gfpgan_lambda or self.roop_lambda
+            for topic in self.error_topics:
+                error_lambda.add_event_source(lambda_events.SnsEventSource(topic))
+
+    def add_stage_event_source(self, prefix, lambda_func, s3_prefix):
+        if not self.stage_queue:
+            self.add_s3_event_source(lambda_func, s3_prefix)
+            return
+
+        dead_letter_queue = sqs.Queue(self, f"{prefix}DeadLetterQueue",
+            retention_period=Duration.days(14)
+        )
+        queue = sqs.Queue(self, f"{prefix}StageQueue",
+            # Six times the function timeout, as Lambda recommends for SQS event sources
+            visibility_timeout=Duration.seconds(6 * 300),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=dead_letter_queue)
+        )
+        self.bucket.add_event_notification(s3.EventType.OBJECT_CREATED, s3n.SqsDestination(queue), s3.NotificationKeyFilter(prefix=s3_prefix))
+
+        # One message per invocation and one endpoint call at a time in it, so the requests in flight never
+        # exceed what the endpoint instances serve: 4 gunicorn workers on each 4-vCPU ml.g4dn.xlarge
+        lambda_func.add_environment("RECORD_WORKERS", "1")
+        lambda_func.add_event_source(lambda_events.SqsEventSource(queue,
+            batch_size=1,
+            max_concurrency=max(2, 4 * self.endpoint_instance_count),
+            report_batch_item_failures=True
+        ))
+        CfnOutput(self, f"{prefix}DeadLetterQueueUrl", value=dead_letter_queue.queue_url, description=f"The dead-letter queue of the {prefix} stage")
 
     def add_s3_event_source(self, lambda_func, prefix):
         lambda_func.add_event_source(lambda_events.S3EventSource(self.bucket,
@@ -114,8 +336,13 @@ class ImageProcessingLambdaStack(Stack):
 
     def create_outputs(self):
         self.create_lambda_outputs("Roop", self.roop_lambda)
-        self.create_lambda_outputs("Gfpgan", self.gfpgan_lambda)
+        if self.gfpgan_lambda:
+            self.create_lambda_outputs("Gfpgan", self.gfpgan_lambda)
         self.create_lambda_outputs("FaceDetection", self.face_detection_lambda)
+        CfnOutput(self, "JobStatusTableName", value=self.job_table.table_name, description="The name of the job status table")
+        if self.result_distribution:
+            CfnOutput(self, "ResultCdnDomainName", value=self.result_distribution.distribution_domain_name, description="The domain name of the result distribution")
+            CfnOutput(self, "ResultCdnKeyPairId", value=self.cdn_public_key.public_key_id, description="The key pair ID to sign result URLs with")
 
     def create_lambda_outputs(self, prefix, lambda_func):
         CfnOutput(self, f"{prefix}LambdaName", value=lambda_func.function_name, description=f"The name of the {prefix} Lambda function")
@@ -125,7 +352,8 @@ class ImageProcessingLambdaStack(Stack):
 
     def add_s3_cors_rule(self):
         self.bucket.add_cors_rule(
-            allowed_methods=[s3.HttpMethods.PUT],
+            # PUT for single uploads, POST for the presigned POST targets of batch uploads
+            allowed_methods=[s3.HttpMethods.PUT, s3.HttpMethods.POST],
             allowed_origins=["*"],
             allowed_headers=["*"],
             max_age=3000
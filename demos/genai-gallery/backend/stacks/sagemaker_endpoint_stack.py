@@ -2,6 +2,7 @@ from aws_cdk import Stack, CustomResource
 from aws_cdk import aws_sagemaker as sagemaker
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_s3 as s3
+from aws_cdk import aws_sns as sns
 from constructs import Construct
 
 class SageMakerEndpointStack(Stack):
@@ -10,7 +11,21 @@ class SageMakerEndpointStack(Stack):
 
         # Add a dependency on the CodeBuild status resource
         self.node.add_dependency(codebuild_status_resource)
-        
+
+        s3_base_bucket_name = self.node.try_get_context("s3_base_bucket_name")
+        s3_bucket_name = f"{s3_base_bucket_name}-{self.account}"
+        s3_base_images_path = self.node.try_get_context("s3_base_images_path")
+        # 'chain' runs roop and GFPGAN on two endpoints, 'fused' runs both in the roop endpoint
+        pipeline_mode = self.node.try_get_context("pipeline_mode") or "chain"
+        # 'sync' Lambdas wait on invoke_endpoint, 'async' queues requests and notifies the next stage through SNS
+        self.inference_mode = self.node.try_get_context("inference_mode") or "sync"
+        self.s3_bucket_name = s3_bucket_name
+        # Instances behind each endpoint; the Lambda stack sizes the stage queues from the same value
+        endpoint_instance_count = self.node.try_get_context("endpoint_instance_count") or 1
+
+        self.success_topics = {}
+        self.error_topics = {}
+
         # Create IAM Role for SageMaker
         sagemaker_role = iam.Role(self, "SageMakerExecutionRole",
             assumed_by=iam.ServicePrincipal("sagemaker.amazonaws.com"),
@@ -26,49 +41,32 @@ class SageMakerEndpointStack(Stack):
             execution_role_arn=sagemaker_role.role_arn,
             primary_container={
                 "image": roop_image_uri,
-                "mode": "SingleModel"
+                "mode": "SingleModel",
+                "environment": {
+                    # Preload the base images and their analysed faces at container start
+                    "TARGET_CACHE_BUCKET": s3_bucket_name,
+                    "TARGET_CACHE_PREFIX": s3_base_images_path,
+                    "PIPELINE_MODE": "swap+restore" if pipeline_mode == "fused" else "swap"
+                }
             },
             model_name="roop-model"
         )
 
-        # Create SageMaker Model for GFPGAN
-        gfpgan_model = sagemaker.CfnModel(self, "GfpganModel",
-            execution_role_arn=sagemaker_role.role_arn,
-            primary_container={
-                "image": gfpgan_image_uri,
-                "mode": "SingleModel"
-            },
-            model_name="gfpgan-model"
-        )
-
         # Create SageMaker Endpoint Configuration for Roop
         roop_endpoint_config = sagemaker.CfnEndpointConfig(self, "RoopEndpointConfig",
             production_variants=[
                 {
-                    "initialInstanceCount": 1,
+                    "initialInstanceCount": endpoint_instance_count,
                     "instanceType": "ml.g4dn.xlarge",
                     "modelName": roop_model.model_name,
                     "variantName": "RoopVariant"
                 }
             ],
+            async_inference_config=self.create_async_inference_config("Roop", "roop", sagemaker_role),
             endpoint_config_name="roop-endpoint-config"
         )
         roop_endpoint_config.add_dependency(roop_model)
 
-        # Create SageMaker Endpoint Configuration for GFPGAN
-        gfpgan_endpoint_config = sagemaker.CfnEndpointConfig(self, "GfpganEndpointConfig",
-            production_variants=[
-                {
-                    "initialInstanceCount": 1,
-                    "instanceType": "ml.g4dn.xlarge",
-                    "modelName": gfpgan_model.model_name,
-                    "variantName": "GfpganVariant"
-                }
-            ],
-            endpoint_config_name="gfpgan-endpoint-config"
-        )
-        gfpgan_endpoint_config.add_dependency(gfpgan_model)
-
         # Create SageMaker Endpoint for Roop
         roop_endpoint = sagemaker.CfnEndpoint(self, "RoopEndpoint",
             endpoint_config_name=roop_endpoint_config.endpoint_config_name,
@@ -76,13 +74,68 @@ class SageMakerEndpointStack(Stack):
         )
         roop_endpoint.add_dependency(roop_endpoint_config)
 
-        # Create SageMaker Endpoint for GFPGAN
-        gfpgan_endpoint = sagemaker.CfnEndpoint(self, "GfpganEndpoint",
-            endpoint_config_name=gfpgan_endpoint_config.endpoint_config_name,
-            endpoint_name="gfpgan-endpoint"
-        )
-        gfpgan_endpoint.add_dependency(gfpgan_endpoint_config)
-
         # Expose endpoint names as properties
         self.roop_endpoint_name = roop_endpoint.endpoint_name
-        self.gfpgan_endpoint_name = gfpgan_endpoint.endpoint_name
\ No newline at end of file
+        self.roop_success_topic = self.success_topics.get("Roop")
+        self.roop_error_topic = self.error_topics.get("Roop")
+        self.gfpgan_endpoint_name = None
+
+        # The fused pipeline restores inside the roop endpoint, so GFPGAN needs no endpoint of its own
+        if pipeline_mode != "fused":
+            # Create SageMaker Model for GFPGAN
+            gfpgan_model = sagemaker.CfnModel(self, "GfpganModel",
+                execution_role_arn=sagemaker_role.role_arn,
+                primary_container={
+                    "image": gfpgan_image_uri,
+                    "mode": "SingleModel"
+                },
+                model_name="gfpgan-model"
+            )
+
+            # Create SageMaker Endpoint Configuration for GFPGAN
+            gfpgan_endpoint_config = sagemaker.CfnEndpointConfig(self, "GfpganEndpointConfig",
+                production_variants=[
+                    {
+                        "initialInstanceCount": endpoint_instance_count,
+                        "instanceType": "ml.g4dn.xlarge",
+                        "modelName": gfpgan_model.model_name,
+                        "variantName": "GfpganVariant"
+                    }
+                ],
+                async_inference_config=self.create_async_inference_config("Gfpgan", "gfpgan", sagemaker_role),
+                endpoint_config_name="gfpgan-endpoint-config"
+            )
+            gfpgan_endpoint_config.add_dependency(gfpgan_model)
+
+            # Create SageMaker Endpoint for GFPGAN
+            gfpgan_endpoint = sagemaker.CfnEndpoint(self, "GfpganEndpoint",
+                endpoint_config_name=gfpgan_endpoint_config.endpoint_config_name,
+                endpoint_name="gfpgan-endpoint"
+            )
+            gfpgan_endpoint.add_dependency(gfpgan_endpoint_config)
+
+            self.gfpgan_endpoint_name = gfpgan_endpoint.endpoint_name
+
+        self.gfpgan_error_topic = self.error_topics.get("Gfpgan")
+
+    def create_async_inference_config(self, prefix, output_name, sagemaker_role):
+        if self.inference_mode != "async":
+            return None
+
+        # SageMaker publishes the outcome of every asynchronous inference to one of these topics
+        success_topic = sns.Topic(self, f"{prefix}AsyncSuccessTopic")
+        error_topic = sns.Topic(self, f"{prefix}AsyncErrorTopic")
+        success_topic.grant_publish(sagemaker_role)
+        error_topic.grant_publish(sagemaker_role)
+        self.success_topics[prefix] = success_topic
+        self.error_topics[prefix] = error_topic
+
+        return {
+            "outputConfig": {
+                "s3OutputPath": f"s3://{self.s3_bucket_name}/async/output/{output_name}/",
+                "notificationConfig": {
+                    "successTopic": success_topic.topic_arn,
+                    "errorTopic": error_topic.topic_arn
+                }
+            }
+        }
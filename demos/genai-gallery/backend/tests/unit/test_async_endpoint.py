@@ -0,0 +1,91 @@
+import importlib.util
+import json
+import os
+import types
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..", "..")
+LAMBDA_DIR = os.path.join(BACKEND_DIR, "lambda")
+LAYER_DIR = os.path.join(LAMBDA_DIR, "layers", "pipeline_common", "python")
+
+
+def load_handler(name, monkeypatch):
+    # Every stage's handler is an index.py, so each one is loaded under its own module name
+    monkeypatch.syspath_prepend(os.path.join(LAMBDA_DIR, name))
+    spec = importlib.util.spec_from_file_location(f"{name}_index", os.path.join(LAMBDA_DIR, name, "index.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("SAGEMAKER_ENDPOINT_NAME", "unused")
+    monkeypatch.setenv("OUTPUT_PATH", "images/result/")
+    monkeypatch.syspath_prepend(LAYER_DIR)
+    from pipeline_common.endpoint import LocalEndpoint
+
+    roop = load_handler("roop", monkeypatch)
+    gfpgan = load_handler("gfpgan", monkeypatch)
+    monkeypatch.setattr(roop, "ENDPOINT_MODE", "async")
+    monkeypatch.setattr(gfpgan, "ENDPOINT_MODE", "async")
+    monkeypatch.setattr(roop, "get_random_image", lambda bucket, prefix, seed=None: "images/base/1.png")
+
+    stages = types.SimpleNamespace(roop=roop, gfpgan=gfpgan, restores=[], notifications=[], failed={})
+
+    def update_job(uuid, state, *args, **fields):
+        if state == "failed":
+            stages.failed[uuid] = fields["error"]
+    monkeypatch.setattr(gfpgan, "update_job", update_job)
+    gfpgan.endpoint = LocalEndpoint(lambda payload: stages.restores.append(payload) or {**payload, "status": "completed"})
+    # The SNS success and error topics of the roop endpoint trigger the GFPGAN stage
+    stages.connect_roop = lambda predictor: setattr(roop, "endpoint", LocalEndpoint(
+        predictor, notify=lambda event, context: stages.notifications.append(gfpgan.lambda_handler(event, context))))
+    return stages
+
+
+def s3_event(key):
+    return {"Records": [{"s3": {"bucket": {"name": "gallery"}, "object": {"key": key, "eTag": "etag"}}}]}
+
+
+def test_async_swap_triggers_restore_through_completion(stages):
+    stages.connect_roop(lambda payload: {**payload, "output": "images/swapped/1234.png", "status": "completed"})
+
+    response = stages.roop.lambda_handler(s3_event("images/face/1234.png"), None)
+
+    assert response["results"][0]["statusCode"] == 202
+    # GFPGAN restores the output named in the roop response, which read_completion returned
+    assert stages.notifications[0]["results"][0]["statusCode"] == 202
+    assert stages.restores == [{"uuid": "1234", "bucket": "gallery", "source": "images/swapped/1234.png", "output": "images/result/1234.png"}]
+
+
+def test_async_swap_failure_reaches_restore_stage_as_error(stages):
+    def failing_predictor(payload):
+        raise RuntimeError("No face detected in the source image")
+    stages.connect_roop(failing_predictor)
+
+    response = stages.roop.lambda_handler(s3_event("images/face/1234.png"), None)
+
+    # The invocation is accepted; the failure arrives with the error notification
+    assert response["results"][0]["statusCode"] == 202
+    assert stages.notifications[0]["statusCode"] == 500
+    assert "No face detected in the source image" in json.loads(stages.notifications[0]["results"][0]["body"])["error"]
+    assert stages.restores == []
+    # The job is failed through the inferenceId of the notification
+    assert "No face detected in the source image" in stages.failed["1234"]
+
+
+def test_async_restore_failure_fails_the_job(stages):
+    from pipeline_common.endpoint import LocalEndpoint
+    def failing_restore(payload):
+        raise RuntimeError("GFPGAN out of memory")
+    # The GFPGAN endpoint's error topic is subscribed by the GFPGAN stage itself
+    stages.gfpgan.endpoint = LocalEndpoint(failing_restore, notify=lambda event, context: stages.notifications.append(stages.gfpgan.lambda_handler(event, context)))
+    stages.connect_roop(lambda payload: {**payload, "output": "images/swapped/1234.png", "status": "completed"})
+
+    stages.roop.lambda_handler(s3_event("images/face/1234.png"), None)
+
+    assert [notification["statusCode"] for notification in stages.notifications] == [500, 202]
+    assert "GFPGAN out of memory" in stages.failed["1234"]
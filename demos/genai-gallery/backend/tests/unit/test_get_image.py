@@ -0,0 +1,47 @@
+import base64
+import importlib.util
+import json
+import os
+
+import pytest
+
+GET_IMAGE_INDEX = os.path.join(os.path.dirname(__file__), "..", "..", "lambda", "apis", "get_image", "index.py")
+
+
+@pytest.fixture
+def get_image(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    spec = importlib.util.spec_from_file_location("get_image_index", GET_IMAGE_INDEX)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def list_images(get_image, **query):
+    return get_image.handler({"resource": "/apis/images", "queryStringParameters": query}, None)
+
+
+def test_cursor_round_trip(get_image):
+    key = {"uuid": "1234", "event_id": "default", "completed_at": 1700000000}
+
+    assert get_image.decode_cursor(get_image.encode_cursor(key), ("event_id", "default")) == key
+
+
+@pytest.mark.parametrize("key", [
+    ["not", "an", "object"],
+    {"uuid": "1234", "event_id": "default"},
+    {"uuid": "1234", "event_id": "default", "completed_at": 1700000000, "state": "completed"},
+    {"uuid": "1234", "event_id": "default", "completed_at": "1700000000"},
+    {"uuid": 1234, "event_id": "default", "completed_at": 1700000000},
+    # The cursor of another index or partition
+    {"uuid": "1234", "batch_id": "batch", "completed_at": 1700000000},
+    {"uuid": "1234", "event_id": "other", "completed_at": 1700000000}
+])
+def test_tampered_cursor_is_rejected(get_image, key):
+    response = list_images(get_image, cursor=cursor(key))
+
+    assert response["statusCode"] == 400
@@ -0,0 +1,259 @@
+import json
+import os
+
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import aws_cdk.aws_sns as sns
+import pytest
+
+from stacks.image_processing_lambda_stack import ImageProcessingLambdaStack
+from stacks.api_gateway_stack import ApiGatewayStack
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..", "..")
+
+# Test key only; the matching private key is not used anywhere
+CDN_PUBLIC_KEY = """-----BEGIN PUBLIC KEY-----
+MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEAtbbaaUqF6q7rm7tSD3VP
+ovMwuMF5/+M4BAOAiJacXJCvGxi9hflK9fcOZm6933VZs/1RCXkSIszDjscy4Npi
+gjzhpfvAyCwZT6+tYt5mV+0l35kdK1G0Q2HXIlphJQk3oTHIq8+K56HyTL8rWk2+
+9BysOhoUYfH1KcE+FOZXtT0CRzGTPA041QhPIx/BzjUmseHTiLghoCNMmMLPWNSj
+DeftsQpP03AlTAxfEImufLy3HWlebBsCmrX1l9ZtVyy72fL4l+6cT5ds5VnZnq6q
+Vnro63pmGgtzxc2owBYVySUcRBjNNVc8X6sh/ixlGQCxlH7Tenk3AepiIow8H9ES
+fwIDAQAB
+-----END PUBLIC KEY-----"""
+
+CDN_CONTEXT = {
+    "result_cdn": True,
+    "cdn_public_key": CDN_PUBLIC_KEY,
+    "cdn_private_key_secret_name": "genai-gallery/cdn-private-key",
+    "cryptography_layer_arn": "arn:aws:lambda:us-east-1:770693421928:layer:Klayers-p39-cryptography:1"
+}
+
+
+@pytest.fixture(autouse=True)
+def backend_dir(monkeypatch):
+    # Lambda code and base images are assets relative to the CDK app directory
+    monkeypatch.chdir(BACKEND_DIR)
+
+
+def create_stacks(**context):
+    with open("cdk.context.json") as file:
+        app = core.App(context={**json.load(file), **context})
+    lambda_stack = ImageProcessingLambdaStack(app, "ImageProcessingLambdaStack",
+                                              roop_endpoint_name="roop-endpoint",
+                                              gfpgan_endpoint_name="gfpgan-endpoint")
+    api_stack = ApiGatewayStack(app, "ApiGatewayStack",
+                                job_table=lambda_stack.job_table,
+                                result_distribution=lambda_stack.result_distribution,
+                                cdn_public_key=lambda_stack.cdn_public_key)
+    return assertions.Template.from_stack(lambda_stack), assertions.Template.from_stack(api_stack)
+
+
+def test_no_distribution_by_default():
+    lambda_template, api_template = create_stacks()
+
+    lambda_template.resource_count_is("AWS::CloudFront::Distribution", 0)
+    api_template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "index.handler",
+        "Environment": {"Variables": assertions.Match.object_like({
+            "OBJECT_PATH": "images/result/",
+            "CDN_DOMAIN_NAME": assertions.Match.absent()
+        })}
+    })
+
+
+def test_result_behavior_requires_signed_urls():
+    lambda_template, _ = create_stacks(**CDN_CONTEXT)
+
+    lambda_template.resource_count_is("AWS::CloudFront::Distribution", 1)
+    lambda_template.has_resource_properties("AWS::CloudFront::Distribution", {
+        "DistributionConfig": assertions.Match.object_like({
+            "DefaultCacheBehavior": assertions.Match.object_like({
+                "TrustedKeyGroups": assertions.Match.any_value(),
+                # CachingDisabled managed policy
+                "CachePolicyId": "4135ea2d-6df8-44a3-9df3-4b5a84be39ad"
+            }),
+            "CacheBehaviors": [assertions.Match.object_like({
+                "PathPattern": "images/result/*",
+                "TrustedKeyGroups": assertions.Match.any_value(),
+                "ViewerProtocolPolicy": "https-only"
+            })]
+        })
+    })
+
+
+def test_result_cache_policy_keeps_results_for_a_year():
+    lambda_template, _ = create_stacks(**CDN_CONTEXT)
+
+    lambda_template.has_resource_properties("AWS::CloudFront::CachePolicy", {
+        "CachePolicyConfig": assertions.Match.object_like({
+            "DefaultTTL": 31536000,
+            "MaxTTL": 31536000,
+            "MinTTL": 86400,
+            "ParametersInCacheKeyAndForwardedToOrigin": assertions.Match.object_like({
+                "QueryStringsConfig": {"QueryStringBehavior": "none"},
+                "HeadersConfig": {"HeaderBehavior": "none"},
+                "CookiesConfig": {"CookieBehavior": "none"}
+            })
+        })
+    })
+    lambda_template.has_resource_properties("AWS::CloudFront::ResponseHeadersPolicy", {
+        "ResponseHeadersPolicyConfig": assertions.Match.object_like({
+            "CustomHeadersConfig": {"Items": [{
+                "Header": "Cache-Control",
+                "Value": "public, max-age=31536000, immutable",
+                "Override": True
+            }]}
+        })
+    })
+
+
+def test_get_image_signs_cdn_urls():
+    _, api_template = create_stacks(**CDN_CONTEXT)
+
+    api_template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "index.handler",
+        "Environment": {"Variables": assertions.Match.object_like({
+            "OBJECT_PATH": "images/result/",
+            "CDN_DOMAIN_NAME": assertions.Match.any_value(),
+            "CDN_KEY_PAIR_ID": assertions.Match.any_value(),
+            "CDN_PRIVATE_KEY_SECRET": "genai-gallery/cdn-private-key"
+        })},
+        "Layers": [CDN_CONTEXT["cryptography_layer_arn"]]
+    })
+
+
+def test_batch_upload_resource():
+    lambda_template, api_template = create_stacks()
+
+    api_template.has_resource_properties("AWS::ApiGateway::Resource", {"PathPart": "batch"})
+    lambda_template.has_resource_properties("AWS::S3::Bucket", {
+        "CorsConfiguration": {"CorsRules": [assertions.Match.object_like({"AllowedMethods": ["PUT", "POST"]})]}
+    })
+
+
+def test_stage_queue_is_off_by_default():
+    lambda_template, _ = create_stacks()
+
+    lambda_template.resource_count_is("AWS::SQS::Queue", 0)
+    lambda_template.resource_count_is("AWS::Lambda::EventSourceMapping", 0)
+
+
+def test_stage_queue_concurrency_matches_endpoint_capacity():
+    lambda_template, _ = create_stacks(stage_queue=True, endpoint_instance_count=2)
+
+    # A stage queue and a dead-letter queue for roop and for GFPGAN
+    lambda_template.resource_count_is("AWS::SQS::Queue", 4)
+    lambda_template.has_resource_properties("AWS::SQS::Queue", {
+        "VisibilityTimeout": 1800,
+        "RedrivePolicy": assertions.Match.object_like({"maxReceiveCount": 3})
+    })
+    lambda_template.resource_properties_count_is("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": 1,
+        "ScalingConfig": {"MaximumConcurrency": 8},
+        "FunctionResponseTypes": ["ReportBatchItemFailures"]
+    }, 2)
+
+
+def create_async_lambda_stack(topic_names, **context):
+    with open("cdk.context.json") as file:
+        app = core.App(context={**json.load(file), "inference_mode": "async", **context})
+    # Stand-ins for the SNS topics of the asynchronous endpoints
+    topic_stack = core.Stack(app, "TopicStack")
+    topics = {name: sns.Topic(topic_stack, name) for name in topic_names}
+    lambda_stack = ImageProcessingLambdaStack(app, "ImageProcessingLambdaStack",
+                                              roop_endpoint_name="roop-endpoint",
+                                              gfpgan_endpoint_name="gfpgan-endpoint",
+                                              **topics)
+    return assertions.Template.from_stack(lambda_stack)
+
+
+@pytest.mark.parametrize("pipeline_mode, topic_names", [
+    ("chain", ["roop_success_topic", "roop_error_topic", "gfpgan_error_topic"]),
+    # The fused pipeline deploys no GFPGAN endpoint
+    ("fused", ["roop_error_topic"])
+])
+def test_async_error_topics_reach_a_stage(pipeline_mode, topic_names):
+    lambda_template = create_async_lambda_stack(topic_names, pipeline_mode=pipeline_mode)
+
+    # GFPGAN follows the roop success topic and both error topics, the fused roop stage its error topic
+    lambda_template.resource_properties_count_is("AWS::SNS::Subscription", {"Protocol": "lambda"}, len(topic_names))
+
+
+def test_pipeline_lambdas_claim_records():
+    lambda_template, _ = create_stacks()
+
+    lambda_template.has_resource_properties("AWS::DynamoDB::Table", {
+        "KeySchema": [{"AttributeName": "claim_key", "KeyType": "HASH"}],
+        "TimeToLiveSpecification": {"AttributeName": "expires_at", "Enabled": True}
+    })
+    # Face detection, roop and GFPGAN
+    lambda_template.resource_properties_count_is("AWS::Lambda::Function", {
+        "Environment": {"Variables": assertions.Match.object_like({"IDEMPOTENCY_TABLE_NAME": assertions.Match.any_value()})}
+    }, 3)
+
+
+def test_result_cache_is_read_by_the_roop_stage():
+    lambda_template, _ = create_stacks(result_cache=True)
+
+    lambda_template.has_resource_properties("AWS::DynamoDB::Table", {
+        "KeySchema": [{"AttributeName": "cache_key", "KeyType": "HASH"}]
+    })
+    lambda_template.resource_properties_count_is("AWS::Lambda::Function", {
+        "Environment": {"Variables": assertions.Match.object_like({
+            "RESULT_CACHE_TABLE_NAME": assertions.Match.any_value(),
+            "RESULT_PATH": "images/result/",
+            "RESULT_CACHE_VERSION": "1"
+        })}
+    }, 1)
+    # result_index copies each result to the identical uploads that wait for it
+    lambda_template.has_resource_properties("AWS::IAM::Policy", {
+        "Roles": [{"Ref": assertions.Match.string_like_regexp("ResultIndexLambdaServiceRole")}],
+        "PolicyDocument": {"Statement": assertions.Match.array_with([assertions.Match.object_like({
+            "Action": assertions.Match.array_with(["s3:PutObject"]),
+            "Resource": assertions.Match.array_with([{"Fn::Join": ["", [assertions.Match.any_value(), "/images/result/*"]]}])
+        })])}
+    })
+
+
+def test_completed_results_are_indexed_for_the_gallery():
+    lambda_template, api_template = create_stacks()
+
+    lambda_template.has_resource_properties("AWS::DynamoDB::Table", {
+        "KeySchema": [{"AttributeName": "uuid", "KeyType": "HASH"}],
+        "GlobalSecondaryIndexes": assertions.Match.array_with([
+            assertions.Match.object_like({
+                "IndexName": "event-index",
+                "KeySchema": [
+                    {"AttributeName": "event_id", "KeyType": "HASH"},
+                    {"AttributeName": "completed_at", "KeyType": "RANGE"}
+                ]
+            }),
+            assertions.Match.object_like({"IndexName": "batch-index"})
+        ])
+    })
+    lambda_template.has_resource_properties("Custom::S3BucketNotifications", {
+        "NotificationConfiguration": {"LambdaFunctionConfigurations": assertions.Match.array_with([
+            assertions.Match.object_like({"Filter": {"Key": {"FilterRules": [
+                {"Name": "suffix", "Value": ".png"},
+                {"Name": "prefix", "Value": "images/result/"}
+            ]}}})
+        ])}
+    })
+    api_template.has_resource_properties("AWS::ApiGateway::Method", {
+        "HttpMethod": "GET",
+        "ResourceId": {"Ref": assertions.Match.string_like_regexp("GenAIGalleryImageApiapisimages[0-9A-F]+$")}
+    })
+
+
+def test_preview_results_are_written_by_the_roop_stage():
+    lambda_template, _ = create_stacks(preview_results=True)
+
+    lambda_template.resource_properties_count_is("AWS::Lambda::Function", {
+        "Environment": {"Variables": assertions.Match.object_like({"PREVIEW_PATH": "images/result/"})}
+    }, 1)
+
+
+def test_result_cdn_requires_public_key():
+    with pytest.raises(ValueError, match="cdn_public_key"):
+        create_stacks(result_cdn=True)
@@ -0,0 +1,70 @@
+import importlib
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+BYOC_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "byoc")
+
+# Holds every call for a second, so that concurrent calls pile up in the model queue
+STUB_MODEL = """
+import time
+
+class StubModel:
+    def hold(self, value):
+        time.sleep(1)
+        return value
+
+def create_model():
+    return StubModel()
+"""
+
+
+@pytest.fixture(params=["roop", "gfpgan"])
+def model_server(request, tmp_path, monkeypatch):
+    # model_server.py runs as a script like serve starts it, with a queue of one call
+    src_dir = os.path.abspath(os.path.join(BYOC_DIR, request.param, "src"))
+    (tmp_path / "stub_model.py").write_text(STUB_MODEL)
+    address = str(tmp_path / "model_server.sock")
+    server = subprocess.Popen([sys.executable, os.path.join(src_dir, "model_server.py")], env={
+        **os.environ, "MODEL_MODULE": "stub_model", "PYTHONPATH": str(tmp_path),
+        "MODEL_SERVER_SOCKET": address, "MODEL_QUEUE_DEPTH": "1"
+    })
+
+    # The client side imports model_server like a gunicorn worker does
+    for name in ("model_server", "batcher"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    monkeypatch.syspath_prepend(src_dir)
+    module = importlib.import_module("model_server")
+    client = module.ModelClient(address)
+    deadline = time.monotonic() + 10
+    while not client.is_ready() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    yield module, client
+    server.kill()
+    server.wait()
+
+
+def test_full_queue_reaches_the_worker_as_model_server_busy(model_server):
+    module, client = model_server
+    outcomes = []
+
+    def call(value):
+        try:
+            outcomes.append(client.hold(value))
+        except Exception as e:
+            outcomes.append(e)
+
+    threads = [threading.Thread(target=call, args=(value,)) for value in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # One call runs and one waits in the queue; the others are turned away with the exception the predictor maps to a 503
+    busy = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    assert busy and all(isinstance(error, module.ModelServerBusy) for error in busy)
+    assert len(outcomes) - len(busy) >= 1
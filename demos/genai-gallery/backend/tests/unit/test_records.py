@@ -0,0 +1,55 @@
+import json
+import os
+
+import pytest
+
+LAYER_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "lambda", "layers", "pipeline_common", "python")
+
+
+@pytest.fixture
+def records(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.syspath_prepend(LAYER_DIR)
+    from pipeline_common import idempotency, records
+
+    # Every claim is already held, in the status the test sets
+    claims = {}
+    monkeypatch.setattr(idempotency, "claim", lambda key: False)
+    monkeypatch.setattr(idempotency, "claim_status", lambda key: claims.get(key))
+    monkeypatch.setattr(records, "claims", claims, raising=False)
+    return records
+
+
+def s3_record(key):
+    return {"s3": {"bucket": {"name": "gallery"}, "object": {"key": key, "eTag": "etag"}}}
+
+
+def fail_if_processed(record):
+    raise AssertionError("A claimed record was processed")
+
+
+def test_completed_claim_is_skipped(records):
+    records.claims["swap#gallery/images/face/1234.png#etag"] = "completed"
+
+    response = records.handle_event({"Records": [s3_record("images/face/1234.png")]}, "swap", fail_if_processed)
+
+    assert response["statusCode"] == 200
+
+
+def test_claim_in_progress_is_retried(records):
+    records.claims["swap#gallery/images/face/1234.png#etag"] = "in_progress"
+
+    # Lambda retries an S3 or SNS event whose invocation raises
+    with pytest.raises(records.ClaimInProgress):
+        records.handle_event({"Records": [s3_record("images/face/1234.png")]}, "swap", fail_if_processed)
+
+
+def test_claim_in_progress_returns_to_the_queue(records):
+    records.claims["swap#gallery/images/face/1234.png#etag"] = "in_progress"
+    records.claims["swap#gallery/images/face/5678.png#etag"] = "completed"
+    messages = [{"eventSource": "aws:sqs", "messageId": key, "body": json.dumps({"Records": [s3_record(f"images/face/{key}.png")]})}
+                for key in ("1234", "5678")]
+
+    response = records.handle_event({"Records": messages}, "swap", fail_if_processed)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "1234"}]}
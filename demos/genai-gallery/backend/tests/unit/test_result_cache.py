@@ -0,0 +1,75 @@
+import time
+import types
+
+import pytest
+
+from tests.unit.test_async_endpoint import LAYER_DIR, load_handler, s3_event
+
+
+@pytest.fixture
+def roop(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("SAGEMAKER_ENDPOINT_NAME", "unused")
+    monkeypatch.setenv("OUTPUT_PATH", "images/swapped/")
+    monkeypatch.syspath_prepend(LAYER_DIR)
+    from pipeline_common.endpoint import LocalEndpoint
+
+    roop = load_handler("roop", monkeypatch)
+    result_cache = roop.result_cache
+    # In-memory stand-ins for the result cache and job tables, with the semantics of their conditional writes
+    state = types.SimpleNamespace(owners={}, jobs={}, swaps=[])
+
+    def put_owner(key, uuid, expected_owner):
+        if state.owners.get(key, (None,))[0] != expected_owner:
+            return False
+        state.owners[key] = (uuid, int(time.time()))
+        return True
+
+    def update_job(uuid, job_state, *args, **fields):
+        job = state.jobs.setdefault(uuid, {"uuid": uuid})
+        job.update(fields, **({"state": job_state} if job_state else {}))
+
+    def add_duplicate(uuid, duplicate_uuid):
+        if uuid not in state.jobs:
+            return None
+        state.jobs[uuid].setdefault("duplicates", set()).add(duplicate_uuid)
+        return dict(state.jobs[uuid])
+
+    monkeypatch.setattr(result_cache, "enabled", lambda: True)
+    monkeypatch.setattr(result_cache, "content_hash", lambda bucket, key: "face-hash")
+    monkeypatch.setattr(result_cache, "put_owner", put_owner)
+    monkeypatch.setattr(result_cache, "lookup", lambda key: state.owners.get(key, (None, 0)))
+    monkeypatch.setattr(result_cache, "add_duplicate", add_duplicate)
+    monkeypatch.setattr(result_cache, "get_job", lambda uuid: dict(state.jobs.get(uuid, {})))
+    monkeypatch.setattr(roop, "update_job", update_job)
+    monkeypatch.setattr(roop, "get_random_image", lambda bucket, prefix, seed=None: "images/base/1.png")
+    monkeypatch.setattr(roop, "endpoint", LocalEndpoint(
+        lambda payload: state.swaps.append(payload["uuid"]) or {**payload, "status": "completed"}))
+    monkeypatch.setattr(roop, "state", state, raising=False)
+    return roop
+
+
+def test_identical_upload_becomes_a_duplicate(roop):
+    roop.lambda_handler(s3_event("images/face/1111.png"), None)
+    response = roop.lambda_handler(s3_event("images/face/2222.png"), None)
+
+    assert response["statusCode"] == 200
+    assert roop.state.swaps == ["1111"]
+    assert roop.state.jobs["1111"]["duplicates"] == {"2222"}
+    assert roop.state.jobs["2222"]["cached_from"] == "1111"
+
+
+def test_stuck_upload_is_taken_over(roop):
+    roop.lambda_handler(s3_event("images/face/1111.png"), None)
+    key, = roop.state.owners
+    # 1111 never reached a final state, and 2222 waits for it
+    roop.state.owners[key] = ("1111", int(time.time()) - roop.result_cache.OWNER_TIMEOUT_SECONDS - 1)
+    roop.state.jobs["1111"]["duplicates"] = {"2222"}
+
+    roop.lambda_handler(s3_event("images/face/3333.png"), None)
+
+    assert roop.state.swaps == ["1111", "3333"]
+    assert roop.state.owners[key][0] == "3333"
+    # result_index copies the result of 3333 to the upload that waited for 1111
+    assert roop.state.jobs["3333"]["duplicates"] == {"2222"}
+
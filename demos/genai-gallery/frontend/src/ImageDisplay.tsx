@@ -11,10 +11,14 @@ const ImageDisplay = () => {
     const { uuid } = useParams<{ uuid: string }>();
     const [ curTime, setCurTime ] = useState<number>(Date.now());
     const [ timeSpent, setTimeSpent ] = useState(0);
+    const [ jobState, setJobState ] = useState("");
+    const [ resultType, setResultType ] = useState("");
     
     const callApi = async () => {
         try{
-            const response = await fetch(`${process.env.REACT_APP_API_ENDPOINT}/apis/images/${uuid}`, {
+            // Long poll: the API answers once the job state or the result type (preview or final) differs from
+            // the one we know, or after 20 seconds. The screen-size WebP rendition instead of the full-size PNG
+            const response = await fetch(`${process.env.REACT_APP_API_ENDPOINT}/apis/images/${uuid}?size=screen&format=webp&state=${jobState}&result=${resultType}&wait=20`, {
                 method: 'GET',
                 headers: { 'Content-Type': 'application/json' }
             });
@@ -25,14 +29,20 @@ const ImageDisplay = () => {
     }
 
     const { data } = useQuery({
-        queryKey: ['display'], 
+        queryKey: ['display', jobState, resultType], 
         queryFn: callApi,
-        refetchInterval: 5000,
+        // Each request already waits on the server, so the next one can follow shortly until the job is done
+        refetchInterval: (query) => ['completed', 'failed'].includes(query.state.data?.state) ? false : 1000,
         refetchIntervalInBackground: true,
     });
 
     useEffect(() => {
-        if(data && data.uuid){
+        if(data && data.state){
+            setJobState(data.state);
+        }
+        if(data && data.downloadUrl){
+              // A preview of the swap is shown until the restored image replaces it
+              setResultType(data.resultType);
               setImg(data);
         }
     }, [data]);